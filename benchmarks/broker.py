@@ -0,0 +1,137 @@
+import asyncio
+import struct
+from logging import debug as log
+from threading import Event, Thread
+
+from paho.mqtt.client import topic_matches_sub
+
+
+# Minimal MQTT 3.1.1 broker, just enough to stand in for Mosquitto in benchmarks.
+# Every message is delivered with QoS 0 and there are no sessions or wills.
+
+
+class MQTTBroker:
+    CONNECT = 1
+    PUBLISH = 3
+    PUBREL = 6
+    SUBSCRIBE = 8
+    UNSUBSCRIBE = 10
+    PINGREQ = 12
+    DISCONNECT = 14
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self._subscriptions = {}
+        self._retained = {}
+        self._loop = None
+        self._ready = Event()
+        self._thread = None
+
+    def start(self) -> int:
+        log("MQTTBroker: Starting")
+        self._thread = Thread(target=self._serve, name="MQTTBroker", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        log("MQTTBroker: Listening on " + self.host + ":" + str(self.port))
+        return self.port
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def _serve(self):
+        self._loop = asyncio.new_event_loop()
+        server = self._loop.run_until_complete(asyncio.start_server(self._handle, self.host, self.port))
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    @staticmethod
+    def _packet(first: int, body: bytes) -> bytes:
+        header = bytearray([first])
+        length = len(body)
+        while True:
+            byte = length % 128
+            length //= 128
+            header.append(byte | (128 if length > 0 else 0))
+            if length == 0:
+                break
+        return bytes(header) + body
+
+    def _publish_packet(self, topic: str, payload: bytes, retain: bool = False) -> bytes:
+        encoded = topic.encode('utf-8')
+        return self._packet(0x30 | (1 if retain else 0), struct.pack('!H', len(encoded)) + encoded + payload)
+
+    @staticmethod
+    async def _read_packet(reader) -> tuple:
+        first = (await reader.readexactly(1))[0]
+        multiplier, length = 1, 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 127) * multiplier
+            multiplier *= 128
+            if byte & 128 == 0:
+                break
+        body = await reader.readexactly(length) if length > 0 else b''
+        return first, body
+
+    @staticmethod
+    def _read_topics(body: bytes, with_qos: bool) -> list:
+        topics = []
+        position = 2
+        while position < len(body):
+            length = struct.unpack('!H', body[position:position + 2])[0]
+            topics.append(body[position + 2:position + 2 + length].decode('utf-8'))
+            position += 2 + length + (1 if with_qos else 0)
+        return topics
+
+    def _route(self, topic: str, payload: bytes):
+        packet = self._publish_packet(topic, payload)
+        for writer, filters in self._subscriptions.items():
+            if any(topic_matches_sub(sub, topic) for sub in filters):
+                writer.write(packet)
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                first, body = await self._read_packet(reader)
+                kind = first >> 4
+                if kind == self.CONNECT:
+                    writer.write(self._packet(0x20, b'\x00\x00'))
+                elif kind == self.PUBLISH:
+                    qos = (first >> 1) & 3
+                    length = struct.unpack('!H', body[:2])[0]
+                    topic = body[2:2 + length].decode('utf-8')
+                    payload = body[2 + length:]
+                    if qos > 0:
+                        writer.write(self._packet(0x40 if qos == 1 else 0x50, payload[:2]))
+                        payload = payload[2:]
+                    if first & 1:
+                        if len(payload) > 0:
+                            self._retained[topic] = payload
+                        else:
+                            self._retained.pop(topic, None)
+                    self._route(topic, payload)
+                elif kind == self.SUBSCRIBE:
+                    topics = self._read_topics(body, True)
+                    self._subscriptions.setdefault(writer, set()).update(topics)
+                    writer.write(self._packet(0x90, body[:2] + bytes(len(topics))))
+                    for topic, payload in self._retained.items():
+                        if any(topic_matches_sub(sub, topic) for sub in topics):
+                            writer.write(self._publish_packet(topic, payload, True))
+                elif kind == self.UNSUBSCRIBE:
+                    self._subscriptions.get(writer, set()).difference_update(self._read_topics(body, False))
+                    writer.write(self._packet(0xB0, body[:2]))
+                elif kind == self.PINGREQ:
+                    writer.write(self._packet(0xD0, b''))
+                elif kind == self.DISCONNECT:
+                    break
+                elif kind == self.PUBREL:
+                    writer.write(self._packet(0x70, body[:2]))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._subscriptions.pop(writer, None)
+            writer.close()
@@ -0,0 +1,201 @@
+import json
+import socket
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import BaseRequestHandler, ThreadingTCPServer
+from logging import debug as log
+from threading import Lock, Thread
+from time import sleep, time
+
+
+# Fake Kodi JSON-RPC server with a synthetic EPG, answering the methods KodiRpc uses.
+# A TCP JSON-RPC port pushes player notifications like Kodi's port 9090 does.
+
+
+class _ReusableTCPServer(ThreadingTCPServer):
+    allow_reuse_address = True
+
+
+class FakeKodi:
+
+    def __init__(self, channels: int = 50, broadcasts: int = 48, latency: float = 0.0,
+                 host: str = "127.0.0.1", port: int = 0):
+        self.channels = channels
+        self.broadcasts = broadcasts
+        self.latency = latency
+        self.calls = []
+        self._calls_lock = Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+        self.playing = False
+        self.paused = False
+        self._listeners = []
+        self._listeners_lock = Lock()
+        self._events_server = _ReusableTCPServer((host, 0), self._events_handler())
+        self._events_server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return "http://" + host + ":" + str(port) + "/jsonrpc"
+
+    @property
+    def events_port(self) -> int:
+        return self._events_server.server_address[1]
+
+    @staticmethod
+    def channel_label(channel_id: int) -> str:
+        return "Channel " + str(channel_id) + " HD"
+
+    @staticmethod
+    def broadcast_title(channel_id: int, slot: int) -> str:
+        return "Show " + str((channel_id * 7 + slot) % 500)
+
+    def start(self) -> str:
+        self._thread = Thread(target=self._server.serve_forever, name="FakeKodi", daemon=True)
+        self._thread.start()
+        Thread(target=self._events_server.serve_forever, name="FakeKodiEvents", daemon=True).start()
+        log("FakeKodi: Listening on " + self.url + ", notifications on port " + str(self.events_port))
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._events_server.shutdown()
+
+    def notify(self, method: str):
+        # Player changes can also be triggered directly, as if the remote had been used
+        self.send(self.notification(method))
+
+    def notification(self, method: str) -> bytes:
+        # Moves the player to the state announced by method and returns the notification, unsent
+        self.playing = method not in ('Player.OnStop', 'System.OnQuit')
+        self.paused = method == 'Player.OnPause'
+        data = {'item': {'type': 'channel'}, 'player': {'playerid': 1, 'speed': 0 if self.paused else 1}}
+        return json.dumps({'jsonrpc': '2.0', 'method': method,
+                           'params': {'sender': 'xbmc', 'data': data}}).encode('utf-8')
+
+    def send(self, data: bytes):
+        # Raw bytes on every notification connection, several notifications or part of one
+        with self._listeners_lock:
+            listeners = list(self._listeners)
+        for connection in listeners:
+            try:
+                connection.sendall(data)
+            except OSError:
+                pass
+
+    def restart_events(self):
+        # Drops every notification connection and listens again on the same port, as a Kodi restart does
+        port = self.events_port
+        self._events_server.shutdown()
+        self._events_server.server_close()
+        with self._listeners_lock:
+            listeners = list(self._listeners)
+        for connection in listeners:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._events_server = _ReusableTCPServer((self._events_server.server_address[0], port),
+                                                 self._events_handler())
+        self._events_server.daemon_threads = True
+        Thread(target=self._events_server.serve_forever, name="FakeKodiEvents", daemon=True).start()
+        log("FakeKodi: Notifications restarted on port " + str(port))
+
+    def calls_to(self, method: str) -> list:
+        with self._calls_lock:
+            return [timestamp for name, timestamp in self.calls if name == method]
+
+    def _epg(self, channel_id: int) -> list:
+        base = datetime.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=1)
+        return [{'broadcastid': channel_id * 100000 + slot,
+                 'label': self.broadcast_title(channel_id, slot),
+                 'starttime': (base + timedelta(minutes=30 * slot)).strftime('%Y-%m-%d %H:%M:%S'),
+                 'endtime': (base + timedelta(minutes=30 * (slot + 1))).strftime('%Y-%m-%d %H:%M:%S')}
+                for slot in range(self.broadcasts)]
+
+    def answer(self, request: dict) -> dict:
+        method = request.get('method')
+        params = request.get('params', {})
+        with self._calls_lock:
+            self.calls.append((method, time()))
+        if method == 'PVR.GetChannelGroups':
+            result = {'channelgroups': [{'channelgroupid': 1, 'label': 'All channels'}]}
+        elif method == 'PVR.GetChannels':
+            result = {'channels': [{'channelid': channel_id, 'label': self.channel_label(channel_id)}
+                                   for channel_id in range(1, self.channels + 1)]}
+        elif method == 'PVR.GetBroadcasts':
+            result = {'broadcasts': self._epg(params['channelid'])}
+        elif method == 'Player.GetActivePlayers':
+            result = [{'playerid': 1, 'playertype': 'internal', 'type': 'video'}] if self.playing else []
+        elif method == 'Player.GetProperties':
+            result = {'speed': 0 if self.paused else 1}
+        else:
+            result = 'OK'
+            if method == 'Player.Open':
+                self.notify('Player.OnPlay')
+            elif method == 'Input.ExecuteAction' and params.get('action') == 'stop' and self.playing:
+                self.notify('Player.OnStop')
+            elif method == 'Input.ExecuteAction' and params.get('action') == 'playpause' and self.playing:
+                self.notify('Player.OnResume' if self.paused else 'Player.OnPause')
+        return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}
+
+    def _handler(self):
+        kodi = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                if kodi.latency > 0:
+                    sleep(kodi.latency)
+                if isinstance(request, list):
+                    response = [kodi.answer(call) for call in request]
+                else:
+                    response = kodi.answer(request)
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def _events_handler(self):
+        kodi = self
+
+        class Handler(BaseRequestHandler):
+
+            def handle(self):
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                with kodi._listeners_lock:
+                    kodi._listeners.append(self.request)
+                decoder = json.JSONDecoder()
+                buffer = ''
+                try:
+                    while True:
+                        chunk = self.request.recv(65536)
+                        if not chunk:
+                            return
+                        buffer += chunk.decode('utf-8')
+                        while len(buffer.strip()) > 0:
+                            try:
+                                request, position = decoder.raw_decode(buffer.lstrip())
+                            except ValueError:
+                                break
+                            buffer = buffer.lstrip()[position:]
+                            self.request.sendall(json.dumps(kodi.answer(request)).encode('utf-8'))
+                except OSError:
+                    pass
+                finally:
+                    with kodi._listeners_lock:
+                        kodi._listeners.remove(self.request)
+
+        return Handler
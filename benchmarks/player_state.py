@@ -0,0 +1,109 @@
+import argparse
+import logging
+import sys
+from logging import debug as log
+from time import monotonic, sleep
+
+from benchmarks.fake_kodi import FakeKodi
+from lib.kodiCtrl import KodiRpc
+from lib.kodiEvents import KodiEventListener
+from lib.metrics import Metrics
+
+
+# Checks that KodiRpc follows the player state pushed by the fake Kodi's notification port:
+# the initial sync, every notification, several of them in one read, one split across reads and a Kodi restart.
+
+
+def notifications_handled() -> int:
+    counters = Metrics().snapshot()['counters']
+    return sum(value for series, value in counters.items() if series.startswith('kodi_notifications_total'))
+
+
+def wait_for(condition, timeout: float) -> bool:
+    deadline = monotonic() + timeout
+    while not condition():
+        if monotonic() > deadline:
+            return False
+        sleep(0.01)
+    return True
+
+
+class PlayerStateCheck:
+
+    def __init__(self, kodi: FakeKodi, timeout: float):
+        self._kodi = kodi
+        self._timeout = timeout
+        self._rpc = KodiRpc()
+        self.failures = []
+
+    def expect(self, name: str, playing: bool, paused: bool, handled: int = None):
+        reached = wait_for(lambda: (self._rpc.is_playing(), self._rpc.is_paused()) == (playing, paused)
+                           and (handled is None or notifications_handled() >= handled), self._timeout)
+        state = (self._rpc.is_playing(), self._rpc.is_paused())
+        print(("PASS " if reached else "FAIL ") + name + ": playing=" + str(state[0]) + " paused=" + str(state[1]))
+        if not reached:
+            self.failures.append(name)
+
+    def run(self):
+        # Kodi is already paused when the orchestrator starts, only the initial queries can tell
+        self._kodi.playing = True
+        self._kodi.paused = True
+        self._rpc.start_events()
+        self.expect("initial sync", True, True)
+
+        for method, playing, paused in (('Player.OnResume', True, False),
+                                        ('Player.OnPause', True, True),
+                                        ('Player.OnPlay', True, False),
+                                        ('Player.OnStop', False, False),
+                                        ('Player.OnAVStart', True, False),
+                                        ('System.OnQuit', False, False)):
+            self._kodi.notify(method)
+            self.expect(method, playing, paused)
+
+        handled = notifications_handled()
+        methods = ['Player.OnPlay', 'Player.OnPause', 'Player.OnResume', 'Player.OnStop', 'Player.OnPlay',
+                   'Player.OnPause']
+        self._kodi.send(b''.join(self._kodi.notification(method) for method in methods))
+        self.expect("notifications in one read", True, True, handled + len(methods))
+
+        notification = self._kodi.notification('Player.OnResume')
+        self._kodi.send(notification[:len(notification) // 2])
+        sleep(0.2)
+        self._kodi.send(notification[len(notification) // 2:])
+        self.expect("notification split across reads", True, False)
+
+        # The state changes while the connection is down, so it can only be learnt again on reconnection
+        self._kodi.playing = False
+        self._kodi.paused = False
+        self._kodi.restart_events()
+        self.expect("sync after restart, stopped", False, False)
+        self._kodi.notify('Player.OnPlay')
+        self.expect("Player.OnPlay after restart", True, False)
+        self._kodi.playing = True
+        self._kodi.paused = True
+        self._kodi.restart_events()
+        self.expect("sync after restart, paused", True, True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Checks the player state followed from Kodi notifications")
+    parser.add_argument("--timeout", type=float, default=10.0, help="Seconds to wait for each state")
+    parser.add_argument("--DEBUG", action='store_const', const=logging.DEBUG, default=logging.WARNING)
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=arguments.DEBUG)
+    # Reconnections are retried quickly so the restart checks don't wait for the default backoff
+    KodiEventListener.RECONNECT_MIN_DELAY = 0.1
+    kodi = FakeKodi(channels=1, broadcasts=1)
+    KodiRpc(kodi.start(), kodi.events_port)
+    log("PlayerStateCheck: Notifications on port " + str(kodi.events_port))
+    check = PlayerStateCheck(kodi, arguments.timeout)
+    check.run()
+    kodi.stop()
+    if len(check.failures) > 0:
+        print(str(len(check.failures)) + " check(s) failed: " + ", ".join(check.failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
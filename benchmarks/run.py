@@ -0,0 +1,250 @@
+import argparse
+import json
+import logging
+import os
+import subprocess
+import tempfile
+from datetime import datetime
+from logging import debug as log
+from threading import Condition, Thread
+from time import sleep, time
+
+import paho.mqtt.client as mqtt
+
+from benchmarks.broker import MQTTBroker
+from benchmarks.fake_kodi import FakeKodi
+from lib.kodiCtrl import KodiRpc
+from lib.reminders import ReminderData
+from lib.reminderStore import STORES
+from lib.scheduler import TimerScheduler
+from orchestrator.remind import ReminderIDSenderParallelService, ReminderManagementParallelService, \
+    ReminderTimersService
+from orchestrator.runtime import build_services, configure_endpoints, run_asyncio, start_router, start_threads, \
+    start_workers, use_asyncio
+from orchestrator.tv import TVBroadcastRemindersParallelService, TVChannelParellelService, TVGuideParallelService
+
+
+class Probe:
+
+    def __init__(self, host: str, port: int, topics: list):
+        self._arrivals = {}
+        self._condition = Condition()
+        self._client = mqtt.Client()
+        self._client.on_message = self.__on_message
+        self._client.connect(host, port)
+        self._client.subscribe([(topic, 0) for topic in topics])
+        self._client.loop_start()
+
+    def __on_message(self, client, userdata, message):
+        self.record(message.topic)
+
+    def record(self, key: str):
+        with self._condition:
+            self._arrivals.setdefault(key, []).append(time())
+            self._condition.notify_all()
+
+    def arrivals(self, key: str) -> list:
+        with self._condition:
+            return list(self._arrivals.get(key, []))
+
+    def wait(self, key: str, count: int, timeout: float) -> list:
+        deadline = time() + timeout
+        with self._condition:
+            while len(self._arrivals.get(key, [])) < count and time() < deadline:
+                self._condition.wait(deadline - time())
+            return list(self._arrivals.get(key, []))
+
+    def publish(self, topic: str, payload: str):
+        self._client.publish(topic, payload)
+
+    def stop(self):
+        self._client.disconnect()
+        self._client.loop_stop()
+
+
+def percentile(values: list, pct: float) -> float:
+    if len(values) == 0:
+        return None
+    position = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[position]
+
+
+def summarize(topic: str, sends: list, completions: list) -> dict:
+    latencies = sorted((done - sent) * 1000.0 for sent, done in zip(sends, completions))
+    elapsed = completions[len(latencies) - 1] - sends[0] if len(latencies) > 0 else 0.0
+    return {'topic': topic,
+            'sent': len(sends),
+            'completed': len(latencies),
+            'throughput_per_s': len(latencies) / elapsed if elapsed > 0 else None,
+            'mean_ms': sum(latencies) / len(latencies) if len(latencies) > 0 else None,
+            'p50_ms': percentile(latencies, 50),
+            'p99_ms': percentile(latencies, 99)}
+
+
+def measure(probe: Probe, topic: str, payloads: list, completion_key: str, timeout: float,
+            completions=None) -> dict:
+    log("Benchmark: Measuring " + topic)
+    already = len(completions() if completions is not None else probe.arrivals(completion_key))
+    sends = []
+    for payload in payloads:
+        sends.append(time())
+        probe.publish(topic, payload)
+    if completions is None:
+        done = probe.wait(completion_key, already + len(payloads), timeout)[already:]
+    else:
+        deadline = time() + timeout
+        while len(completions()) < already + len(payloads) and time() < deadline:
+            sleep(0.01)
+        done = completions()[already:]
+    return summarize(topic, sends, done)
+
+
+def bench_reminder_add(probe: Probe, count: int, timeout: float) -> dict:
+    payloads = [json.dumps({'action': 'ADD', 'hour': 1 + i % 23, 'minute': i % 60, 'weekday': 1 + i % 7,
+                            'concept': i % 10}) for i in range(count)]
+    return measure(probe, ReminderManagementParallelService.LISTEN_CHANNEL, payloads,
+                   ReminderManagementParallelService.ANSWER_CHANNEL, timeout)
+
+
+def bench_reminder_list(probe: Probe, count: int, timeout: float) -> dict:
+    return measure(probe, ReminderIDSenderParallelService.LISTEN_CHANNEL, ["LIST"] * count,
+                   ReminderIDSenderParallelService.ANSWER_CHANNEL, timeout)
+
+
+def bench_reminder_notify(probe: Probe, timers: ReminderTimersService, count: int, timeout: float) -> dict:
+    log("Benchmark: Measuring reminder notifications")
+    topic = ReminderTimersService.ANSWER_CHANNEL
+    already = len(probe.arrivals(topic))
+    r_ids = [reminder.id for reminder in ReminderData().get_all_reminders()[:count]]
+    deadline = time() + 0.5
+    TimerScheduler().schedule_many([(r_id, deadline) for r_id in r_ids], timers.notify_all)
+    if ReminderTimersService.LEGACY_NOTIFICATIONS:
+        done = probe.wait(topic, already + len(r_ids), timeout)[already:]
+    else:
+        # Reminders due together arrive in a single message
+        done = probe.wait(topic, already + 1, timeout)[already:already + 1] * len(r_ids)
+    return summarize(topic, [deadline] * len(done), done)
+
+
+def bench_channel_switch(probe: Probe, kodi: FakeKodi, count: int, timeout: float) -> dict:
+    payloads = [FakeKodi.channel_label(1 + i % kodi.channels)[:-3] for i in range(count)]
+    return measure(probe, TVChannelParellelService.LISTEN_CHANNEL, payloads, None, timeout,
+                   completions=lambda: kodi.calls_to('Player.Open'))
+
+
+def bench_broadcast_reminder(probe: Probe, kodi: FakeKodi, count: int, timeout: float) -> dict:
+    ReminderData().register_add_callback(lambda r_id: probe.record('broadcast-added'))
+    payloads = [FakeKodi.broadcast_title(1 + i % kodi.channels, kodi.broadcasts - 1) for i in range(count)]
+    return measure(probe, TVBroadcastRemindersParallelService.LISTEN_CHANNEL, payloads, 'broadcast-added', timeout)
+
+
+def bench_guide(probe: Probe, kodi: FakeKodi, count: int, timeout: float) -> dict:
+    queries = [{'query': 'now', 'channel': FakeKodi.channel_label(1 + i % kodi.channels)} if i % 2 == 0 else
+               {'query': 'titles', 'prefix': FakeKodi.broadcast_title(1 + i % kodi.channels, 0)[:-1]}
+               for i in range(count)]
+    return measure(probe, TVGuideParallelService.LISTEN_CHANNEL, [json.dumps(query) for query in queries],
+                   TVGuideParallelService.ANSWER_CHANNEL, timeout)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, baseline_file: str):
+    with open(baseline_file, 'r') as baseline_json:
+        baseline = json.load(baseline_json)['results']
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for metric in ('throughput_per_s', 'p50_ms', 'p99_ms'):
+            if before.get(metric) and result.get(metric) is not None:
+                change = (result[metric] - before[metric]) / before[metric] * 100.0
+                print("%-20s %-18s %12.3f -> %12.3f (%+.1f%%)" % (name, metric, before[metric], result[metric],
+                                                                  change))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the Dámaso orchestrator")
+    parser.add_argument("--mode", choices=['router', 'asyncio', 'threads'], default='router')
+    parser.add_argument("--count", type=int, default=200, help="Messages sent per scenario")
+    parser.add_argument("--channels", type=int, default=200, help="PVR channels served by the fake Kodi")
+    parser.add_argument("--broadcasts", type=int, default=48, help="EPG entries per channel")
+    parser.add_argument("--store", choices=sorted(STORES), default='memory', help="Reminder store backend")
+    parser.add_argument("--workers", type=int, default=4, help="Handler worker threads (0 runs handlers inline)")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds of latency injected per Kodi request")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Seconds to wait for each scenario")
+    parser.add_argument("--output", default="benchmark.json", help="File to write the JSON results to")
+    parser.add_argument("--compare", default=None, metavar='JSON', help="Previous results to compare against")
+    parser.add_argument("--DEBUG", action='store_const', const=logging.DEBUG, default=logging.WARNING)
+    arguments = parser.parse_args()
+
+    logging.basicConfig(level=arguments.DEBUG)
+    output = os.path.abspath(arguments.output)
+    baseline = os.path.abspath(arguments.compare) if arguments.compare is not None else None
+    os.chdir(tempfile.mkdtemp(prefix="orchestrator-bench-"))
+
+    broker = MQTTBroker()
+    port = broker.start()
+    kodi = FakeKodi(arguments.channels, arguments.broadcasts, arguments.latency)
+    configure_endpoints("127.0.0.1:" + str(port), kodi.start(), kodi.events_port)
+    ReminderData.__wrapped__.STORE = arguments.store
+
+    started = time()
+    if arguments.mode == 'asyncio':
+        use_asyncio()
+    services = build_services()
+    if arguments.mode != 'asyncio':
+        start_workers(arguments.workers, 100, 'block')
+    if arguments.mode == 'threads':
+        for service in services:
+            if isinstance(service, Thread):
+                service.daemon = True
+        start_threads(services)
+    elif arguments.mode == 'asyncio':
+        Thread(target=run_asyncio, args=(services,), daemon=True).start()
+    else:
+        start_router(services)
+    startup = time() - started
+    timers = next(service for service in services if isinstance(service, ReminderTimersService))
+
+    started = time()
+    # Kodi is warmed up in the background once the services are subscribed
+    KodiRpc()._get_snapshot()
+    epg_crawl = time() - started
+
+    probe = Probe("127.0.0.1", port, [ReminderManagementParallelService.ANSWER_CHANNEL,
+                                     ReminderIDSenderParallelService.ANSWER_CHANNEL,
+                                     ReminderTimersService.ANSWER_CHANNEL,
+                                     TVGuideParallelService.ANSWER_CHANNEL])
+    sleep(1.0)
+
+    results = {'reminder_add': bench_reminder_add(probe, arguments.count, arguments.timeout),
+               'reminder_list': bench_reminder_list(probe, arguments.count, arguments.timeout),
+               'reminder_notify': bench_reminder_notify(probe, timers, arguments.count, arguments.timeout),
+               'channel_switch': bench_channel_switch(probe, kodi, arguments.count, arguments.timeout),
+               'broadcast_reminder': bench_broadcast_reminder(probe, kodi, arguments.count, arguments.timeout),
+               'guide': bench_guide(probe, kodi, arguments.count, arguments.timeout)}
+    probe.stop()
+
+    report = {'timestamp': datetime.now().isoformat(),
+              'commit': git_commit(),
+              'config': {'mode': arguments.mode, 'store': arguments.store, 'workers': arguments.workers,
+                         'count': arguments.count, 'channels': arguments.channels, 'broadcasts': arguments.broadcasts,
+                         'latency': arguments.latency},
+              'startup_s': startup,
+              'epg_crawl_s': epg_crawl,
+              'results': results}
+    with open(output, 'w') as output_json:
+        json.dump(report, output_json, indent=2)
+    print(json.dumps(report, indent=2))
+    if baseline is not None:
+        compare(results, baseline)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,45 +1,140 @@
 import argparse
 import logging
+import os
+import sys
+import threading
 
-from orchestrator.proactivity import *
-from orchestrator.remind import *
-from orchestrator.tv import *
+from lib.metrics import serve_prometheus
+from lib.reminders import ReminderData
+from lib.reminderStore import STORES
+from lib.sites import load_sites
+from lib.startup import StartupReport
+from lib.workers import OrderedWorkerPool
+from orchestrator.runtime import SUBSYSTEMS, build_services, configure_endpoints, connect_early, run_asyncio, \
+    run_router, run_threads, start_workers, use_asyncio
+from orchestrator.proactivity import ProactiveManagementParallelService
+from orchestrator.remind import ReminderTimersService
+from orchestrator.stats import StatsPublisherService
+from orchestrator.supervisor import Supervisor, exit_on_thread_death, parse_affinity
+from orchestrator.tv import TVBroadcastRemindersParallelService
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Orchestrator for the Dámaso project")
 
     parser.add_argument("--DEBUG", action='store_const', const=logging.DEBUG, default=logging.INFO,
                         metavar='Enables debug-level logging')
+    parser.add_argument("--MODE", choices=['router', 'asyncio', 'threads', 'supervisor'], default='router',
+                        help="router shares one MQTT connection among all services, "
+                             "asyncio serves them from an event loop with coroutine handlers, "
+                             "threads runs one MQTT client thread per service, "
+                             "supervisor runs each subsystem in a router-mode worker process and restarts it if it "
+                             "dies")
+    parser.add_argument("--SUBSYSTEM", choices=list(SUBSYSTEMS), default=None,
+                        help="Only run the services of this subsystem (used by the supervisor for its workers)")
+    parser.add_argument("--AFFINITY", nargs='+', default=None, metavar='SUBSYSTEM=CPUS',
+                        help="Pin supervisor workers to CPUs, e.g. reminders=0 tv=2,3")
+    parser.add_argument("--BROKER", default=None, metavar='HOST[:PORT]',
+                        help="MQTT broker to connect to (default: localhost:1883)")
+    parser.add_argument("--KODI", default=None, metavar='URL',
+                        help="Kodi JSON-RPC endpoint (default: http://localhost:8080/jsonrpc)")
+    parser.add_argument("--KODI-EVENTS-PORT", type=int, default=None, metavar='PORT',
+                        help="Kodi TCP JSON-RPC port to follow player notifications on (default: 9090, 0 disables "
+                             "it and the player state is guessed from the commands sent)")
+    parser.add_argument("--EPG-CACHE", default=None, metavar='FILE',
+                        help="Where the EPG is kept between runs (default: epg.cache, an empty name disables it)")
+    parser.add_argument("--REMINDER-STORE", choices=sorted(STORES), default=ReminderData.__wrapped__.STORE,
+                        help="memory keeps reminders in memory with a pickle snapshot and a journal, sqlite keeps "
+                             "them in an indexed SQLite database (reminders.db) that other processes can read")
+    parser.add_argument("--CATCH-UP", choices=ReminderTimersService.CATCH_UP_POLICIES,
+                        default=ReminderTimersService.CATCH_UP,
+                        help="Reminders missed while the orchestrator was down: fire all of them, only the latest "
+                             "ones or none")
+    proactive = ProactiveManagementParallelService
+    parser.add_argument("--PRESENCE-HOLD", type=float, nargs=2, metavar=('ON', 'OFF'),
+                        default=[proactive.ON_HOLD, proactive.OFF_HOLD],
+                        help="Seconds the presence sensor has to keep reporting someone, or nobody, before the TV "
+                             "reacts; shorter flickers are ignored")
+    parser.add_argument("--IDLE-STOP", type=float, default=proactive.TIMER_DEADLINE,
+                        metavar='SECONDS', help="Stop playback when nobody comes back this long after a pause")
+    parser.add_argument("--LEGACY-NOTIFICATIONS", action='store_true',
+                        help="Publish one message per due reminder with only its concept, instead of a single "
+                             "message listing every reminder due in that minute")
+    parser.add_argument("--SITES", default=None, metavar='FILE',
+                        help="Serve every site listed in this JSON file from this process, on /dsh/<site>/ topics")
+    parser.add_argument("--STATS-INTERVAL", type=float, default=StatsPublisherService.PUBLISH_INTERVAL,
+                        metavar='SECONDS', help="Publish runtime metrics on " + StatsPublisherService.ANSWER_CHANNEL
+                                                + " this often, 0 disables it")
+    parser.add_argument("--METRICS-PORT", type=int, default=None, metavar='PORT',
+                        help="Also expose metrics in Prometheus text format on this local port")
+    parser.add_argument("--WORKERS", type=int, default=4, metavar='N',
+                        help="Handler worker threads, messages on the same topic keep their order (0 runs "
+                             "handlers on the MQTT network thread)")
+    parser.add_argument("--QUEUE-SIZE", type=int, default=100, metavar='N',
+                        help="Messages each worker can have waiting")
+    parser.add_argument("--QUEUE-POLICY", choices=OrderedWorkerPool.POLICIES, default='block',
+                        help="What to do when a worker queue is full")
 
     arguments = parser.parse_args()
+    if arguments.SITES is not None and arguments.MODE == 'threads':
+        parser.error("--SITES needs --MODE router or asyncio")
 
     logging.basicConfig(level=arguments.DEBUG)
 
-    orch_proac_awaken_service = ProactiveAwakenParallelService()
-    orch_proac_awaken_service.start()
+    if arguments.MODE == 'supervisor' and arguments.SUBSYSTEM is None:
+        try:
+            affinity = parse_affinity(arguments.AFFINITY)
+        except ValueError as error:
+            parser.error(str(error))
+        if any(subsystem not in SUBSYSTEMS for subsystem in affinity):
+            parser.error("--AFFINITY subsystems are " + ", ".join(SUBSYSTEMS))
+        if len(affinity) > 0 and not hasattr(os, 'sched_setaffinity'):
+            parser.error("--AFFINITY is not supported on this platform")
+        # Workers are started with the same arguments, plus the subsystem each one runs
+        Supervisor([sys.executable, os.path.abspath(sys.argv[0])] + sys.argv[1:], list(SUBSYSTEMS), affinity).run()
+        sys.exit(0)
 
-#    orch_rem_server_service = ReminderSenderParallelService()
-#    orch_rem_server_service.start()
+    subsystems = tuple(SUBSYSTEMS)
+    mode = arguments.MODE
+    if arguments.SUBSYSTEM is not None:
+        subsystems = (arguments.SUBSYSTEM,)
+        if mode == 'supervisor':
+            mode = 'router'
+            threading.excepthook = exit_on_thread_death
+        # Each worker announces itself and publishes its stats on a topic of its own
+        StartupReport.READY_CHANNEL += '/' + arguments.SUBSYSTEM
+        StatsPublisherService.ANSWER_CHANNEL += '/' + arguments.SUBSYSTEM
+        if arguments.METRICS_PORT is not None:
+            arguments.METRICS_PORT += list(SUBSYSTEMS).index(arguments.SUBSYSTEM)
+    owns_reminders = 'reminders' in subsystems
+    TVBroadcastRemindersParallelService.VIA_BROKER = not owns_reminders
 
-    orch_rem_server_service_id = ReminderIDSenderParallelService()
-    orch_rem_server_service_id.start()
+    startup = StartupReport()
+    with startup.phase('configure'):
+        configure_endpoints(arguments.BROKER, arguments.KODI, arguments.KODI_EVENTS_PORT, arguments.EPG_CACHE)
+        ReminderData.__wrapped__.STORE = arguments.REMINDER_STORE
+        ReminderTimersService.CATCH_UP = arguments.CATCH_UP
+        ReminderTimersService.LEGACY_NOTIFICATIONS = arguments.LEGACY_NOTIFICATIONS
+        ProactiveManagementParallelService.ON_HOLD, ProactiveManagementParallelService.OFF_HOLD = \
+            arguments.PRESENCE_HOLD
+        ProactiveManagementParallelService.TIMER_DEADLINE = arguments.IDLE_STOP
+        StatsPublisherService.PUBLISH_INTERVAL = arguments.STATS_INTERVAL
+        if arguments.METRICS_PORT is not None:
+            serve_prometheus(arguments.METRICS_PORT)
+        if mode != 'asyncio':
+            connect_early(startup)
+        else:
+            use_asyncio()
 
-    orch_rem_timers_service = ReminderTimersService()
+    with startup.phase('load'):
+        sites = load_sites(arguments.SITES, with_reminders=owns_reminders) if arguments.SITES is not None else None
+        services = build_services(sites, subsystems)
+        if mode != 'asyncio':
+            start_workers(arguments.WORKERS, arguments.QUEUE_SIZE, arguments.QUEUE_POLICY)
 
-    orch_rem_mngmnt_service = ReminderManagementParallelService()
-    orch_rem_mngmnt_service.start()
-
-    orch_tv_pause_service = TVPauseParallelService()
-    orch_tv_pause_service.start()
-
-    orch_tv_stop_service = TVStopParallelService()
-    orch_tv_stop_service.start()
-
-    orch_tv_channel_service = TVChannelParellelService()
-    orch_tv_channel_service.start()
-
-    orch_tv_broadcast_service = TVBroadcastRemindersParallelService()
-    orch_tv_broadcast_service.start()
-
-    orch_proac_mgmnt_service = ProactiveManagementParallelService()
-    orch_proac_mgmnt_service.start()
+    if mode == 'threads':
+        run_threads(services, sites, startup, subsystems)
+    elif mode == 'asyncio':
+        startup.announce_on_exit()
+        run_asyncio(services, sites, startup, subsystems)
+    else:
+        run_router(services, sites, startup, subsystems)
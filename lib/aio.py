@@ -0,0 +1,189 @@
+import asyncio
+from json import loads as dejson
+from logging import debug as log, warning as logw
+from threading import get_ident
+from urllib.parse import urlsplit
+
+from singleton_decorator import singleton
+
+from lib.communicator import MQTTConnection, MQTTRouter, run_handler
+from lib.kodiCtrl import KodiRpc
+from lib.metrics import Metrics
+
+
+class AsyncMQTTDriver:
+    MISC_INTERVAL: float = 1.0
+    RECONNECT_DELAY: float = 2.0
+
+    def __init__(self):
+        self._loop = None
+        self._loop_thread = None
+        self._tasks = set()
+        self._router = MQTTRouter()
+        self._connection = MQTTConnection()
+        client = self._connection.client
+        client.on_socket_open = self.__on_socket_open
+        client.on_socket_close = self.__on_socket_close
+        client.on_socket_register_write = self.__on_socket_register_write
+        client.on_socket_unregister_write = self.__on_socket_unregister_write
+        self._router.set_dispatcher(self._dispatch)
+        log("AsyncMQTTDriver: Created")
+
+    async def run(self):
+        log("AsyncMQTTDriver: Running")
+        self._loop_thread = get_ident()
+        self._loop = asyncio.get_running_loop()
+        self._connection.start()
+        client = self._connection.client
+        if client.socket() is not None:
+            # Opened before the loop was running, its callbacks had nowhere to register it
+            self._loop.add_reader(client.socket(), client.loop_read)
+            if client.want_write():
+                self._loop.add_writer(client.socket(), client.loop_write)
+        while True:
+            if client.socket() is None:
+                try:
+                    client.reconnect()
+                except OSError:
+                    logw("AsyncMQTTDriver: Broker unreachable, retrying...")
+                    await asyncio.sleep(self.RECONNECT_DELAY)
+                    continue
+            client.loop_misc()
+            await asyncio.sleep(self.MISC_INTERVAL)
+
+    def _dispatch(self, topic: str, action, payload: str):
+        if get_ident() != self._loop_thread:
+            # Tasks can only be created from the loop's own thread
+            self._loop.call_soon_threadsafe(self._dispatch, topic, action, payload)
+            return
+        if asyncio.iscoroutinefunction(action):
+            task = self._loop.create_task(self._guard(topic, action(payload)))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            self._loop.run_in_executor(None, run_handler, topic, action, payload)
+
+    @staticmethod
+    async def _guard(topic: str, coroutine):
+        try:
+            with Metrics().timed('handler_seconds', {'topic': topic}):
+                await coroutine
+        except Exception:
+            logw("AsyncMQTTDriver: Handler for " + topic + " failed", exc_info=True)
+
+    def _in_loop(self, method: str, *args):
+        loop = self._loop
+        if loop is None:
+            # Not running yet, run() registers the socket itself
+            return
+        # Publishers running in executor threads also trigger socket callbacks
+        if get_ident() == self._loop_thread:
+            getattr(loop, method)(*args)
+        else:
+            loop.call_soon_threadsafe(getattr(loop, method), *args)
+
+    def __on_socket_open(self, client, userdata, sock):
+        log("AsyncMQTTDriver: Socket opened")
+        self._in_loop('add_reader', sock, client.loop_read)
+
+    def __on_socket_close(self, client, userdata, sock):
+        log("AsyncMQTTDriver: Socket closed")
+        self._in_loop('remove_reader', sock)
+
+    def __on_socket_register_write(self, client, userdata, sock):
+        self._in_loop('add_writer', sock, client.loop_write)
+
+    def __on_socket_unregister_write(self, client, userdata, sock):
+        self._in_loop('remove_writer', sock)
+
+
+@singleton
+class AsyncKodiRpc:
+    MAX_CONNECTIONS: int = 16
+
+    def __init__(self, kodi: KodiRpc = None):
+        self._kodi = KodiRpc() if kodi is None else kodi
+        self._semaphore = None
+        log("AsyncKodiRpc: Created")
+
+    @staticmethod
+    def _dechunk(content: bytes) -> bytes:
+        body = b''
+        while len(content) > 0:
+            size_line, _, content = content.partition(b'\r\n')
+            size = int(size_line.split(b';')[0], 16)
+            if size == 0:
+                break
+            body += content[:size]
+            content = content[size + 2:]
+        return body
+
+    async def _post(self, rpc_call: str) -> dict:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.MAX_CONNECTIONS)
+        url = urlsplit(self._kodi.URL)
+        body = rpc_call.encode('utf-8')
+        head = ("POST " + (url.path or '/') + " HTTP/1.1\r\n"
+                + "Host: " + url.netloc + "\r\n"
+                + "Content-Type: application/json\r\n"
+                + "Content-Length: " + str(len(body)) + "\r\n"
+                + "Connection: close\r\n\r\n")
+        async with self._semaphore:
+            with Metrics().timed('kodi_rpc_seconds', {'method': self._kodi._method_of(rpc_call)}):
+                reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+                try:
+                    writer.write(head.encode('ascii') + body)
+                    await writer.drain()
+                    raw = await reader.read()
+                finally:
+                    writer.close()
+        headers, _, content = raw.partition(b'\r\n\r\n')
+        if b'transfer-encoding: chunked' in headers.lower():
+            content = self._dechunk(content)
+        return dejson(content.decode('utf-8'))
+
+    async def _get_channel_id_by_name(self, name: str) -> int:
+        if self._kodi._snapshot is None:
+            return await asyncio.get_running_loop().run_in_executor(None, self._kodi._get_channel_id_by_name, name)
+        return self._kodi._get_channel_id_by_name(name)
+
+    async def play_pause(self) -> bool:
+        log("AsyncKodiRpc: Play/pause request")
+        rpc_call = self._kodi._build_json("Input.ExecuteAction", "plps", {'action': 'playpause'})
+        response = await self._post(rpc_call)
+        if response.get('result') == 'OK':
+            self._kodi._assume_player_state(self._kodi.is_playing(), not self._kodi.is_paused())
+            return True
+        return False
+
+    async def play_channel(self, channel_name: str) -> bool:
+        log("AsyncKodiRpc: Request to play " + channel_name)
+        channel_id = await self._get_channel_id_by_name(channel_name)
+        if channel_id is None:
+            logw("AsyncKodiRpc: Channel not found")
+            return False
+        else:
+            rpc_call = self._kodi._build_json("Player.Open", "playch", {'item': {'channelid': channel_id}})
+            response = await self._post(rpc_call)
+            if response.get('result') == 'OK':
+                self._kodi._assume_player_state(True, False)
+                return True
+            return False
+
+    async def stop(self) -> bool:
+        log("AsyncKodiRpc: Request to stop")
+        if not self._kodi.is_playing():
+            logw("AsyncKodiRpc: Not playing anything")
+            return False
+        else:
+            rpc_call = self._kodi._build_json("Input.ExecuteAction", "stp", {'action': 'stop'})
+            response = await self._post(rpc_call)
+            if response.get('result') == 'OK':
+                self._kodi._assume_player_state(False, False)
+                return True
+            else:
+                return False
+
+    async def get_next_time(self, name: str):
+        log("AsyncKodiRpc: Getting next time schedule for " + name)
+        return await asyncio.get_running_loop().run_in_executor(None, self._kodi.get_next_time, name)
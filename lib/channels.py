@@ -0,0 +1,110 @@
+import re
+import unicodedata
+from logging import debug as log
+
+
+class ChannelIndex:
+    NGRAM: int = 3
+    MIN_SCORE: float = 0.5
+    # A best match this close to the runner-up is a guess between two channels, so nothing is played
+    MIN_MARGIN: float = 0.1
+    MAX_CANDIDATES: int = 5
+    COMMON_GRAM_SHARE: float = 0.05
+    # Quality suffixes stripped from labels, the lowest rank wins when a channel comes in several qualities
+    QUALITY_RANK: dict = {'HD': 0, 'FHD': 1, 'UHD': 2, '4K': 2, '': 3, 'SD': 4}
+    _QUALITY = re.compile(r'^(.*?)\s+(HD|FHD|UHD|4K|SD)$', re.IGNORECASE)
+    _NON_ALNUM = re.compile(r'[^0-9A-Z]+')
+    _NUMBER = re.compile(r'[0-9]+')
+
+    def __init__(self, channels: list):
+        self._ids = {}
+        self._names = {}
+        ranks = {}
+        for channel in channels:
+            name, quality = self.split_quality(channel['label'])
+            key = self.normalize(name)
+            if len(key) == 0:
+                continue
+            rank = self.QUALITY_RANK[quality]
+            if key not in ranks or rank < ranks[key]:
+                ranks[key] = rank
+                self._ids[key] = channel['channelid']
+                self._names[key] = name
+        self._grams = {}
+        self._gram_sets = {}
+        for key in self._ids:
+            grams = self._ngrams(key)
+            self._gram_sets[key] = grams
+            for gram in grams:
+                self._grams.setdefault(gram, []).append(key)
+        # Grams shared by many channels ("CHA", "AL ") only seed candidates when nothing rarer matches
+        self._common_limit = max(32, int(len(self._ids) * self.COMMON_GRAM_SHARE))
+        log("ChannelIndex: Indexed " + str(len(self._ids)) + " channels")
+
+    @classmethod
+    def split_quality(cls, label: str) -> tuple:
+        label = label.strip()
+        match = cls._QUALITY.match(label)
+        if match is None:
+            return label, ''
+        return match.group(1), match.group(2).upper()
+
+    @classmethod
+    def normalize(cls, name: str) -> str:
+        decomposed = unicodedata.normalize('NFKD', name)
+        stripped = ''.join(c for c in decomposed if not unicodedata.combining(c))
+        return cls._NON_ALNUM.sub(' ', stripped.upper()).strip()
+
+    @classmethod
+    def _ngrams(cls, key: str) -> set:
+        padded = ' ' + key + ' '
+        return {padded[i:i + cls.NGRAM] for i in range(max(len(padded) - cls.NGRAM + 1, 1))}
+
+    @classmethod
+    def _numbers(cls, key: str) -> list:
+        return cls._NUMBER.findall(key)
+
+    @staticmethod
+    def _dice(grams: set, other: set) -> float:
+        return 2.0 * len(grams & other) / (len(grams) + len(other))
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def names(self) -> list:
+        return list(self._names.values())
+
+    def ids(self) -> list:
+        return list(self._ids.values())
+
+    def candidates(self, name: str, limit: int = None) -> list:
+        key = self.normalize(self.split_quality(name)[0])
+        grams = self._ngrams(key)
+        postings = [self._grams[gram] for gram in grams if gram in self._grams]
+        seeds = set()
+        for posting in postings:
+            if len(posting) <= self._common_limit:
+                seeds.update(posting)
+        if len(seeds) == 0:
+            for posting in postings:
+                seeds.update(posting)
+        # Names that only differ by a number ("La 1", "La 2") are different channels, never misrecognitions
+        numbers = self._numbers(key)
+        ranked = sorted(((self._dice(grams, self._gram_sets[candidate]), candidate) for candidate in seeds
+                         if self._numbers(candidate) == numbers), reverse=True)
+        return [(self._names[candidate], self._ids[candidate], score)
+                for score, candidate in ranked[:limit or self.MAX_CANDIDATES]]
+
+    def lookup(self, name: str) -> int:
+        key = self.normalize(self.split_quality(name)[0])
+        channel_id = self._ids.get(key)
+        if channel_id is not None:
+            return channel_id
+        candidates = self.candidates(name, 2)
+        if len(candidates) == 0 or candidates[0][2] < self.MIN_SCORE:
+            return None
+        if len(candidates) > 1 and candidates[0][2] - candidates[1][2] < self.MIN_MARGIN:
+            log("ChannelIndex: " + name + " is ambiguous between " + candidates[0][0] + " and " + candidates[1][0])
+            return None
+        log("ChannelIndex: Matched " + name + " to " + candidates[0][0])
+        return candidates[0][1]
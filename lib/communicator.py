@@ -1,28 +1,232 @@
-from logging import debug as log
+from collections import deque
+from logging import debug as log, warning as logw
+from threading import Event, Lock
 
 import paho.mqtt.client as mqtt
-import paho.mqtt.publish as publish
+from singleton_decorator import singleton
+
+from lib.metrics import Metrics
+
+
+def run_handler(topic: str, action, payload: str):
+    try:
+        with Metrics().timed('handler_seconds', {'topic': topic}):
+            action(payload)
+    except Exception:
+        logw("Handler for " + topic + " failed", exc_info=True)
+
 
 class MQTTDaemon:
+    DISPATCHER = None
+    SUBSCRIBED_CALLBACK = None
 
     def __init__(self, action, topic: str):
         self.action = action
+        self.topic = topic
+        settings = MQTTConnection()
         self.client = mqtt.Client()
         self.client.on_message = self.__on_message
-        self.client.connect("localhost")
+        self.client.on_subscribe = self.__on_subscribe
+        self.client.connect(settings.HOST, settings.PORT, settings.KEEPALIVE)
         self.client.subscribe(topic)
         self.client.loop_forever()
 
+    def __on_subscribe(self, client, userdata, mid, granted_qos):
+        log("MQTTDaemon: Subscribed to " + self.topic)
+        if MQTTDaemon.SUBSCRIBED_CALLBACK is not None:
+            MQTTDaemon.SUBSCRIBED_CALLBACK(self.topic)
+
     def __on_message(self, client, userdata, message):
         log("MQTTDaemon: Message got")
-        self.action(str(message.payload.decode("utf-8")))
+        Metrics().increment('mqtt_messages_total', {'topic': message.topic})
+        if self.DISPATCHER is not None:
+            self.DISPATCHER(message.topic, self.action, str(message.payload.decode("utf-8")))
+        else:
+            with Metrics().timed('handler_seconds', {'topic': message.topic}):
+                self.action(str(message.payload.decode("utf-8")))
+
+
+@singleton
+class MQTTConnection:
+    HOST: str = "localhost"
+    PORT: int = 1883
+    KEEPALIVE: int = 60
+    MAX_INFLIGHT_MESSAGES: int = 100
+    MAX_PENDING_MESSAGES: int = 10000
+    RECONNECT_MIN_DELAY: int = 1
+    RECONNECT_MAX_DELAY: int = 30
+    # Cleared by the asyncio runtime, which drives paho from its event loop, so no network thread is ever started
+    THREADED: bool = True
+
+    def __init__(self):
+        self._lock = Lock()
+        self._started = False
+        self._connected = False
+        self._pending = deque(maxlen=self.MAX_PENDING_MESSAGES)
+        self._connect_callbacks = []
+        self.client = mqtt.Client()
+        self.client.max_inflight_messages_set(self.MAX_INFLIGHT_MESSAGES)
+        self.client.reconnect_delay_set(self.RECONNECT_MIN_DELAY, self.RECONNECT_MAX_DELAY)
+        self.client.on_connect = self.__on_connect
+        self.client.on_disconnect = self.__on_disconnect
+        log("MQTTConnection: Created")
+
+    def start(self):
+        with self._lock:
+            if not self._started:
+                log("MQTTConnection: Connecting to " + self.HOST + ":" + str(self.PORT))
+                self.client.connect_async(self.HOST, self.PORT, self.KEEPALIVE)
+                if self.THREADED:
+                    self.client.loop_start()
+                self._started = True
+
+    def set_will(self, topic: str, payload: str, qos: int = 0, retain: bool = False):
+        # Only applies to connections made afterwards
+        log("MQTTConnection: Setting will on " + topic)
+        self.client.will_set(topic, payload, qos, retain)
+
+    def stop(self):
+        with self._lock:
+            if self._started:
+                log("MQTTConnection: Disconnecting")
+                self.client.disconnect()
+                self.client.loop_stop()
+                self._started = False
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def register_connect_callback(self, f: callable):
+        log("MQTTConnection: Registering new connect callback")
+        self._connect_callbacks.append(f)
+        if self._connected:
+            f(self.client)
+
+    def publish(self, topic: str, payload, qos: int = 0, retain: bool = False):
+        self.start()
+        with self._lock:
+            if not self._connected:
+                # Messages sent before the connection is up wait here and are flushed once it is
+                if len(self._pending) == self._pending.maxlen:
+                    logw("MQTTConnection: Pending queue full, dropping oldest message")
+                self._pending.append((topic, payload, qos, retain))
+                return
+        info = self.client.publish(topic, payload, qos, retain)
+        # A QoS 0 message is dropped by paho when the connection has just gone, QoS 1 and 2 ones are already in
+        # paho's outgoing queue and resent by paho itself on reconnect, queueing them here would duplicate them
+        if info.rc == mqtt.MQTT_ERR_NO_CONN and qos == 0:
+            with self._lock:
+                self._pending.append((topic, payload, qos, retain))
+
+    def __on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            logw("MQTTConnection: Connection refused with code " + str(rc))
+            return
+        log("MQTTConnection: Connected")
+        with self._lock:
+            self._connected = True
+            if len(self._pending) > 0:
+                log("MQTTConnection: Flushing " + str(len(self._pending)) + " pending messages")
+            while len(self._pending) > 0:
+                topic, payload, qos, retain = self._pending.popleft()
+                client.publish(topic, payload, qos, retain)
+        for f in self._connect_callbacks:
+            f(client)
+
+    def __on_disconnect(self, client, userdata, rc):
+        with self._lock:
+            self._connected = False
+        if rc != 0:
+            logw("MQTTConnection: Connection lost, reconnecting...")
+
+
+@singleton
+class MQTTRouter:
+
+    def __init__(self):
+        self._handlers = {}
+        self._wildcards = {}
+        self._qos = {}
+        self._dispatch = run_handler
+        self._subscribe_lock = Lock()
+        self._unacknowledged = 0
+        self._subscribed = Event()
+        self._connection = MQTTConnection()
+        self._connection.client.on_message = self.__on_message
+        self._connection.client.on_subscribe = self.__on_subscribe
+        self._connection.register_connect_callback(self.__subscribe_all)
+        log("MQTTRouter: Created")
+
+    def register(self, topic: str, action, qos: int = 0, subscription: str = None):
+        # A wildcard subscription can cover many exact topics, which are still routed with a dict lookup
+        log("MQTTRouter: Routing " + topic)
+        table = self._wildcards if '+' in topic or '#' in topic else self._handlers
+        table.setdefault(topic, []).append(action)
+        subscription = topic if subscription is None else subscription
+        if subscription not in self._qos:
+            self._qos[subscription] = qos
+            if self._connection.is_connected():
+                self._subscribe(self._connection.client, [(subscription, qos)])
+
+    def start(self):
+        self._connection.start()
+
+    def set_dispatcher(self, dispatcher):
+        self._dispatch = dispatcher
+
+    def wait_subscribed(self, timeout: float = None) -> bool:
+        return self._subscribed.wait(timeout)
+
+    def _subscribe(self, client, subscriptions: list):
+        # Our lock is not held while paho sends, its callbacks may be waiting for it
+        with self._subscribe_lock:
+            self._unacknowledged += 1
+            self._subscribed.clear()
+        if client.subscribe(subscriptions)[0] != mqtt.MQTT_ERR_SUCCESS:
+            # Not connected, everything is subscribed again on connect
+            with self._subscribe_lock:
+                self._unacknowledged = max(self._unacknowledged - 1, 0)
+
+    def __on_subscribe(self, client, userdata, mid, granted_qos):
+        with self._subscribe_lock:
+            self._unacknowledged = max(self._unacknowledged - 1, 0)
+            if self._unacknowledged == 0:
+                log("MQTTRouter: Every subscription acknowledged")
+                self._subscribed.set()
+
+    def __subscribe_all(self, client):
+        if len(self._qos) > 0:
+            log("MQTTRouter: Subscribing to " + str(len(self._qos)) + " topics")
+            with self._subscribe_lock:
+                # Subscriptions sent before the connection was lost will never be acknowledged
+                self._unacknowledged = 0
+            self._subscribe(client, list(self._qos.items()))
+
+    def __on_message(self, client, userdata, message):
+        log("MQTTRouter: Message got on " + message.topic)
+        Metrics().increment('mqtt_messages_total', {'topic': message.topic})
+        actions = list(self._handlers.get(message.topic, ()))
+        for sub, wildcard_actions in self._wildcards.items():
+            if mqtt.topic_matches_sub(sub, message.topic):
+                actions.extend(wildcard_actions)
+        if len(actions) == 0:
+            logw("MQTTRouter: No handler for " + message.topic)
+            return
+        payload = str(message.payload.decode("utf-8"))
+        for action in actions:
+            self._dispatch(message.topic, action, payload)
 
 
 class MQTTPublisher:
+    DEFAULT_QOS: int = 0
 
-    def __init__(self, topic: str):
+    def __init__(self, topic: str, qos: int = None, retain: bool = False):
         self.topic = topic
+        self.qos = self.DEFAULT_QOS if qos is None else qos
+        self.retain = retain
+        self._connection = MQTTConnection()
 
     def publish(self, message: str):
-        publish.single(self.topic, payload=message)
+        Metrics().increment('mqtt_published_total', {'topic': self.topic})
+        self._connection.publish(self.topic, message, self.qos, self.retain)
         log("MQTTPublisher: Message published")
@@ -0,0 +1,51 @@
+from logging import debug as log
+from threading import Lock
+from time import time
+
+from lib.metrics import Metrics
+from lib.scheduler import TimerScheduler
+
+
+class Debouncer:
+    DEFAULT_HOLD: float = 1.0
+
+    def __init__(self, key: str, on_change: callable, holds: dict = None):
+        # holds maps each value to the seconds it must last before it is committed, which gives hysteresis
+        self._key = key
+        self._on_change = on_change
+        self._holds = holds or {}
+        self._scheduler = TimerScheduler()
+        self._lock = Lock()
+        self._committed = None
+        self._pending = None
+        self._labels = {'key': key}
+        log("Debouncer: Created for " + key)
+
+    def committed(self):
+        return self._committed
+
+    def push(self, value):
+        Metrics().increment('debounce_events_total', self._labels)
+        with self._lock:
+            if value == self._committed:
+                if self._pending is not None:
+                    # The change did not last long enough, nothing happens
+                    log("Debouncer: " + self._key + " went back to " + str(value))
+                    self._scheduler.cancel(self._key)
+                    self._pending = None
+                Metrics().increment('debounce_coalesced_total', self._labels)
+            elif value == self._pending:
+                Metrics().increment('debounce_coalesced_total', self._labels)
+            else:
+                self._pending = value
+                self._scheduler.schedule(self._key, time() + self._holds.get(value, self.DEFAULT_HOLD), self._commit)
+
+    def _commit(self, keys: list):
+        with self._lock:
+            value = self._pending
+            if value is None:
+                return
+            self._pending = None
+            self._committed = value
+        log("Debouncer: " + self._key + " is now " + str(value))
+        self._on_change(value)
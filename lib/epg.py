@@ -0,0 +1,272 @@
+import heapq
+import mmap
+import os
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+from logging import debug as log, warning as logw
+from time import time
+
+from lib.channels import ChannelIndex
+
+# Kodi's broadcast times are naive, they are stored as seconds since a naive epoch and compared the same way
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_epoch(moment: datetime) -> float:
+    return (moment - EPOCH) / timedelta(seconds=1)
+
+
+def from_epoch(seconds: int) -> datetime:
+    return EPOCH + timedelta(seconds=seconds)
+
+
+def _kodi_time(seconds: int) -> str:
+    return from_epoch(seconds).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class EpgSnapshot:
+    # File layout, every section is an array of native int64 except the final UTF-8 string blob:
+    #   header | key offsets [titles + 1] | label offsets [titles + 1] | first broadcast [titles + 1]
+    #   | starts [broadcasts] | ends [broadcasts] | broadcast channels [broadcasts]
+    #   | channel ids [channels] | channel label offsets [channels + 1] | channel first [channels + 2]
+    #   | channel order [broadcasts] | channel starts [broadcasts] | channel max ends [broadcasts]
+    #   | channel ranks [broadcasts] | strings
+    # Titles are interned and sorted by their normalized key, broadcasts are grouped by title and sorted by start.
+    # Within each channel, plus a last group for broadcasts of unknown channels, broadcasts are listed by start along
+    # with the latest end so far, which finds the first one still airing with a bisection, and with their rank in
+    # the order of every broadcast by start and channel, which merges channels and resumes pages.
+    MAGIC: bytes = b'DEPG'
+    VERSION: int = 3
+    _HEADER = struct.Struct('<4sHHdqqq')
+    _BYTE_ORDER: int = 1 if sys.byteorder == 'little' else 2
+
+    def __init__(self, buffer, channels: ChannelIndex = None):
+        magic, version, byte_order, self.created, titles, broadcasts, channel_count = \
+            self._HEADER.unpack_from(buffer, 0)
+        if magic != self.MAGIC or version != self.VERSION or byte_order != self._BYTE_ORDER:
+            raise ValueError("Not an EPG cache of this version")
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._position = self._HEADER.size
+        self._key_offsets = self._section(titles + 1)
+        self._label_offsets = self._section(titles + 1)
+        self._first = self._section(titles + 1)
+        self._starts = self._section(broadcasts)
+        self._ends = self._section(broadcasts)
+        self._channel_of = self._section(broadcasts)
+        self._channel_ids = self._section(channel_count)
+        self._channel_label_offsets = self._section(channel_count + 1)
+        self._channel_first = self._section(channel_count + 2)
+        self._channel_order = self._section(broadcasts)
+        self._channel_starts = self._section(broadcasts)
+        self._channel_max_ends = self._section(broadcasts)
+        self._channel_ranks = self._section(broadcasts)
+        self._strings = self._view[self._position:]
+        if len(self._strings) < self._channel_label_offsets[channel_count]:
+            raise ValueError("Truncated EPG cache")
+        self._channel_labels = {self._channel_ids[i]: self._string(self._channel_label_offsets, i)
+                                for i in range(channel_count)}
+        self._channel_positions = {self._channel_ids[i]: i for i in range(channel_count)}
+        if channels is None:
+            channels = ChannelIndex([{'label': label, 'channelid': channel_id}
+                                     for channel_id, label in self._channel_labels.items()])
+        self.channels = channels
+
+    def _section(self, count: int) -> memoryview:
+        end = self._position + 8 * count
+        if end > len(self._view):
+            raise ValueError("Truncated EPG cache")
+        section = self._view[self._position:end].cast('q')
+        self._position = end
+        return section
+
+    def _string(self, offsets: memoryview, i: int) -> str:
+        return bytes(self._strings[offsets[i]:offsets[i + 1]]).decode('utf-8')
+
+    @staticmethod
+    def normalize_title(title: str) -> str:
+        return title.strip().upper()
+
+    @staticmethod
+    def _parse_time(text: str) -> int:
+        return int(to_epoch(datetime.fromisoformat(text)))
+
+    @classmethod
+    def build(cls, channels: list, broadcasts: list, index: ChannelIndex = None, created: float = None):
+        log("EpgSnapshot: Packing " + str(len(broadcasts)) + " broadcasts")
+        labels = {}
+        entries = []
+        for br in broadcasts:
+            key = cls.normalize_title(br['label']).encode('utf-8')
+            labels.setdefault(key, br['label'].strip())
+            start = cls._parse_time(br['starttime'])
+            end = cls._parse_time(br['endtime']) if br.get('endtime') else start
+            entries.append((key, start, max(end, start), br.get('channelid', -1)))
+        entries.sort()
+        strings = bytearray()
+        key_offsets, label_offsets, first = array('q', [0]), array('q'), array('q', [0])
+        keys = []
+        for position, (key, _, _, _) in enumerate(entries):
+            if len(keys) == 0 or keys[-1] != key:
+                if len(keys) > 0:
+                    first.append(position)
+                keys.append(key)
+                strings += key
+                key_offsets.append(len(strings))
+        if len(keys) > 0:
+            first.append(len(entries))
+        label_offsets.append(len(strings))
+        for key in keys:
+            strings += labels[key].encode('utf-8')
+            label_offsets.append(len(strings))
+        starts = array('q', (entry[1] for entry in entries))
+        ends = array('q', (entry[2] for entry in entries))
+        channel_of = array('q', (entry[3] for entry in entries))
+        time_order = sorted(range(len(entries)), key=lambda p: (starts[p], channel_of[p]))
+        channel_ids, channel_label_offsets = array('q'), array('q', [len(strings)])
+        for channel in channels:
+            channel_ids.append(channel['channelid'])
+            strings += channel['label'].encode('utf-8')
+            channel_label_offsets.append(len(strings))
+        groups = {channel_id: [] for channel_id in channel_ids}
+        unknown = []
+        for rank, p in enumerate(time_order):
+            groups.get(channel_of[p], unknown).append((rank, p))
+        channel_first, channel_order = array('q', [0]), array('q')
+        channel_starts, channel_max_ends, channel_ranks = array('q'), array('q'), array('q')
+        for group in [groups.pop(channel_id, []) for channel_id in channel_ids] + [unknown]:
+            latest_end = None
+            for rank, p in group:
+                latest_end = ends[p] if latest_end is None else max(latest_end, ends[p])
+                channel_order.append(p)
+                channel_starts.append(starts[p])
+                channel_max_ends.append(latest_end)
+                channel_ranks.append(rank)
+            channel_first.append(len(channel_order))
+        header = cls._HEADER.pack(cls.MAGIC, cls.VERSION, cls._BYTE_ORDER, created if created is not None else time(),
+                                  len(keys), len(entries), len(channel_ids))
+        buffer = b''.join([header] + [section.tobytes() for section in
+                                      (key_offsets, label_offsets, first, starts, ends, channel_of, channel_ids,
+                                       channel_label_offsets, channel_first, channel_order, channel_starts,
+                                       channel_max_ends, channel_ranks)] + [bytes(strings)])
+        return cls(buffer, index)
+
+    @classmethod
+    def load(cls, path: str):
+        try:
+            with open(path, 'rb') as cache:
+                # The mapping stays valid after the file is closed or replaced by a newer cache
+                mapped = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+            snapshot = cls(mapped)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, struct.error):
+            logw("EpgSnapshot: Ignoring unreadable cache " + path, exc_info=True)
+            return None
+        log("EpgSnapshot: Mapped " + path + ", " + str(round(snapshot.age())) + "s old")
+        return snapshot
+
+    def save(self, path: str):
+        directory = os.path.dirname(path)
+        if len(directory) > 0:
+            os.makedirs(directory, exist_ok=True)
+        tmp_file = path + '.tmp'
+        with open(tmp_file, 'wb') as cache:
+            cache.write(self._view)
+        os.replace(tmp_file, path)
+        log("EpgSnapshot: Saved " + path)
+
+    def age(self) -> float:
+        return time() - self.created
+
+    def _lower_bound(self, raw: bytes) -> int:
+        # First title whose key is not below raw, keys are sorted by their UTF-8 bytes
+        low, high = 0, len(self._key_offsets) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if bytes(self._strings[self._key_offsets[middle]:self._key_offsets[middle + 1]]) < raw:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _find_title(self, key: str) -> int:
+        title_id = self._lower_bound(key.encode('utf-8'))
+        if title_id < len(self._key_offsets) - 1 and self._string(self._key_offsets, title_id) == key:
+            return title_id
+        return None
+
+    def next_start(self, title: str, now: datetime) -> datetime:
+        title_id = self._find_title(self.normalize_title(title))
+        if title_id is None:
+            return None
+        end = self._first[title_id + 1]
+        position = bisect_left(self._starts, to_epoch(now), self._first[title_id], end)
+        if position == end:
+            return None
+        return from_epoch(self._starts[position])
+
+    def _broadcast(self, position: int) -> dict:
+        title_id = bisect_right(self._first, position) - 1
+        return {'label': self._string(self._label_offsets, title_id),
+                'starttime': _kodi_time(self._starts[position]),
+                'endtime': _kodi_time(self._ends[position]),
+                'channelid': self._channel_of[position],
+                'channel': self._channel_labels.get(self._channel_of[position])}
+
+    def broadcasts(self):
+        for position in range(len(self._starts)):
+            yield self._broadcast(position)
+
+    def airing(self, start: datetime, end: datetime = None, channel_id: int = None, cursor: int = 0,
+               limit: int = 10) -> tuple:
+        # Broadcasts overlapping [start, end) by start time, end None means no upper bound.
+        # Returns up to limit broadcasts and the cursor of the next page, None on the last one.
+        since = to_epoch(start)
+        until = to_epoch(end) if end is not None else float('inf')
+        if channel_id is None:
+            groups = range(len(self._channel_first) - 1)
+        else:
+            channel = self._channel_positions.get(channel_id)
+            if channel is None:
+                return [], None
+            groups = [channel]
+        # Every channel is bisected to its first broadcast still airing and to the page, then channels are merged
+        heads = []
+        for group in groups:
+            first, last = self._channel_first[group], self._channel_first[group + 1]
+            low = max(bisect_right(self._channel_max_ends, since, first, last),
+                      bisect_left(self._channel_ranks, cursor, first, last))
+            high = bisect_left(self._channel_starts, until, first, last)
+            if low < high:
+                heads.append((self._channel_ranks[low], low, high))
+        heapq.heapify(heads)
+        found = []
+        while len(heads) > 0 and len(found) < limit:
+            _, index, high = heads[0]
+            position = self._channel_order[index]
+            if self._ends[position] > since or self._starts[position] >= since:
+                found.append(self._broadcast(position))
+            if index + 1 < high:
+                heapq.heapreplace(heads, (self._channel_ranks[index + 1], index + 1, high))
+            else:
+                heapq.heappop(heads)
+        return found, heads[0][0] if len(heads) > 0 else None
+
+    def titles(self, prefix: str, now: datetime, cursor: int = 0, limit: int = 10) -> tuple:
+        raw = self.normalize_title(prefix).encode('utf-8')
+        # No UTF-8 sequence contains 0xFF, so this bounds every key starting with the prefix
+        low, high = self._lower_bound(raw), self._lower_bound(raw + b'\xff')
+        moment = to_epoch(now)
+        found = []
+        index = max(low, cursor)
+        while index < high and len(found) < limit:
+            end = self._first[index + 1]
+            position = bisect_left(self._starts, moment, self._first[index], end)
+            found.append({'label': self._string(self._label_offsets, index),
+                          'starttime': _kodi_time(self._starts[position]) if position < end else None})
+            index += 1
+        return found, index if index < high else None
@@ -1,10 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from json import dumps as dictstr
 from logging import debug as log, warning as logw
+from threading import Event, Lock, Thread
+from time import sleep
+from urllib.parse import urlsplit
 
-import requests
 from singleton_decorator import singleton
 
+from lib.channels import ChannelIndex
+from lib.epg import EpgSnapshot
+from lib.kodiEvents import KodiEventListener
+from lib.metrics import Metrics
+
 
 # JSON RPC API reference: https://kodi.wiki/view/JSON-RPC_API/v9
 
@@ -13,12 +21,33 @@ from singleton_decorator import singleton
 class KodiRpc:
     URL: str = "http://localhost:8080/jsonrpc"
     CACHE_VALID_TIME: int = 1200
+    BROADCAST_BATCH_SIZE: int = 25
+    BROADCAST_PARALLELISM: int = 4
+    REFRESH_RETRY_TIME: int = 30
+    COLD_START_TIMEOUT: int = 120
+    EVENTS_PORT: int = KodiEventListener.PORT
+    EPG_CACHE_FILE: str = 'epg.cache'
 
-    def __init__(self):
-        self._channelList = {}
+    def __init__(self, url: str = None, events_port: int = None, site: str = None, cache_file: str = None):
+        if url is not None:
+            self.URL = url
+        if events_port is not None:
+            self.EVENTS_PORT = events_port
+        if cache_file is not None:
+            self.EPG_CACHE_FILE = cache_file
+        self._labels = {'site': site} if site is not None else None
+        self._session = None
         self._playing = False
         self._paused = False
-        self._broadcastsList = []
+        self._snapshot = None
+        self._snapshot_ready = Event()
+        self._cache_lock = Lock()
+        self._cache_checked = False
+        self._refresh_lock = Lock()
+        self._refresher_lock = Lock()
+        self._refresher = None
+        self._events = None
+        Metrics().register_gauge('epg_cache_age_seconds', self._snapshot_age, self._labels)
         log("KodiRpc: Created")
 
     @classmethod
@@ -50,121 +79,226 @@ class KodiRpc:
         json = json + "}"
         return json
 
-    @classmethod
-    def _get_tv_ch_groups(cls, request_id: str) -> list:
+    def _get_session(self):
+        if self._session is None:
+            log("KodiRpc: Opening HTTP session")
+            # requests is slow to import, so it is only loaded once Kodi is first contacted
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(self.BROADCAST_PARALLELISM, 1))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
+
+    @staticmethod
+    def _method_of(rpc_call: str) -> str:
+        if rpc_call.startswith('['):
+            return 'batch'
+        start = rpc_call.find('"method": "') + 11
+        return rpc_call[start:rpc_call.find('"', start)]
+
+    def _post(self, rpc_call: str):
+        with Metrics().timed('kodi_rpc_seconds', {'method': self._method_of(rpc_call)}):
+            return self._get_session().post(url=self.URL, data=rpc_call).json()
+
+    def _post_batch(self, rpc_calls: list) -> list:
+        log("KodiRpc: Sending batch of " + str(len(rpc_calls)) + " calls")
+        return self._post('[' + ', '.join(rpc_calls) + ']')
+
+    def _get_tv_ch_groups(self, request_id: str) -> list:
         log("KodiRpc: Getting all TV channel groups")
         method = "PVR.GetChannelGroups"
         params = {"channeltype": "tv"}
-        rpc_call = cls._build_json(method, request_id, params)
-        response = requests.post(url=cls.URL, data=rpc_call)
-        return response.json()['result']['channelgroups']
+        rpc_call = self._build_json(method, request_id, params)
+        return self._post(rpc_call)['result']['channelgroups']
 
-    @classmethod
-    def _get_main_ch_group(cls, request_id: str) -> int:
+    def _get_main_ch_group(self, request_id: str) -> int:
         log("KodiRpc: Getting main channel group")
-        ch_groups = cls._get_tv_ch_groups(request_id)
+        ch_groups = self._get_tv_ch_groups(request_id)
         return ch_groups[0]['channelgroupid']
 
-    @classmethod
-    def _get_channels(cls, request_id: str) -> list:
+    def _get_channels(self, request_id: str) -> list:
         log("KodiRpc: Getting channels")
-        main_ch_group = cls._get_main_ch_group("chg")
+        main_ch_group = self._get_main_ch_group("chg")
         method = "PVR.GetChannels"
         params = {"channelgroupid": main_ch_group}
-        rpc_call = cls._build_json(method, request_id, params)
-        response = requests.post(url=cls.URL, data=rpc_call)
-        return response.json()['result']['channels']
+        rpc_call = self._build_json(method, request_id, params)
+        return self._post(rpc_call)['result']['channels']
 
-    @classmethod
-    def _play_channel(cls, request_id: str, channel_id: int) -> bool:
+    def _play_channel(self, request_id: str, channel_id: int) -> bool:
         log("KodiRpc: Playing channel " + str(channel_id))
-        rpc_call = cls._build_json("Player.Open", request_id, {'item': {'channelid': channel_id}})
-        response = requests.post(url=cls.URL, data=rpc_call)
-        return response.json().get('result') == 'OK'
+        rpc_call = self._build_json("Player.Open", request_id, {'item': {'channelid': channel_id}})
+        return self._post(rpc_call).get('result') == 'OK'
+
+    def _get_broadcasts_batch(self, channel_ids: list) -> list:
+        log("KodiRpc: Getting broadcasts of " + str(len(channel_ids)) + " channels")
+        rpc_calls = [self._build_json("PVR.GetBroadcasts", "gbrd" + str(channel_id),
+                                     {'channelid': channel_id, 'properties': ['starttime', 'endtime']})
+                     for channel_id in channel_ids]
+        responses = self._post_batch(rpc_calls)
+        broadcasts = []
+        if responses is None:
+            logw("KodiRpc: Kodi has no broadcasts for these channels")
+            return broadcasts
+        for response in responses:
+            result = response.get('result')
+            if result is not None and result.get('broadcasts') is not None:
+                # Batch answers may come in any order, the request id tells the channel
+                channel_id = int(response['id'][len("gbrd"):])
+                for broadcast in result['broadcasts']:
+                    broadcast['channelid'] = channel_id
+                broadcasts.extend(result['broadcasts'])
+        return broadcasts
+
+    @staticmethod
+    def _filter_next(broadcasts: list) -> list:
+        return list(filter(
+            lambda x: datetime.strptime(x['starttime'], '%Y-%m-%d %H:%M:%S') >= datetime.now() - timedelta(days=1),
+            broadcasts))
+
+    def _crawl_channels(self) -> list:
+        log("KodiRpc: Crawling channel list")
+        return self._get_channels("chs")
+
+    def _crawl_broadcasts(self, channel_ids: list) -> list:
+        log("KodiRpc: Crawling broadcasts...")
+        next_broadcasts = []
+        batches = [channel_ids[i:i + self.BROADCAST_BATCH_SIZE]
+                   for i in range(0, len(channel_ids), self.BROADCAST_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=max(self.BROADCAST_PARALLELISM, 1)) as executor:
+            for broadcasts in executor.map(self._get_broadcasts_batch, batches):
+                next_broadcasts.extend(self._filter_next(broadcasts))
+        return next_broadcasts
+
+    def refresh(self) -> bool:
+        if not self._refresh_lock.acquire(blocking=False):
+            log("KodiRpc: EPG refresh already running")
+            return False
+        try:
+            log("KodiRpc: Refreshing EPG")
+            channels = self._crawl_channels()
+            index = ChannelIndex(channels)
+            snapshot = EpgSnapshot.build(channels, self._crawl_broadcasts(index.ids()), index)
+            self._save_cache(snapshot)
+            with self._cache_lock:
+                self._snapshot = snapshot
+            self._snapshot_ready.set()
+            log("KodiRpc: EPG refreshed")
+            return True
+        except Exception:
+            logw("KodiRpc: EPG refresh failed, keeping previous snapshot", exc_info=True)
+            return False
+        finally:
+            self._refresh_lock.release()
+
+    def _save_cache(self, snapshot: EpgSnapshot):
+        if len(self.EPG_CACHE_FILE) == 0:
+            return
+        try:
+            snapshot.save(self.EPG_CACHE_FILE)
+        except OSError:
+            logw("KodiRpc: Could not save the EPG cache", exc_info=True)
 
-    def _get_channel_list(self) -> dict:
+    def _load_cache(self):
+        # A warm restart serves the EPG saved by the previous run until Kodi is crawled again
+        with self._cache_lock:
+            if self._cache_checked or len(self.EPG_CACHE_FILE) == 0:
+                return
+            self._cache_checked = True
+            with Metrics().timed('epg_cache_load_seconds', self._labels):
+                snapshot = EpgSnapshot.load(self.EPG_CACHE_FILE)
+            if snapshot is not None and self._snapshot is None:
+                self._snapshot = snapshot
+                self._snapshot_ready.set()
+
+    def start_refresher(self):
+        with self._refresher_lock:
+            if self._refresher is None:
+                log("KodiRpc: Starting EPG refresher")
+                self._refresher = Thread(target=self._refresh_forever, name="KodiRpcRefresher", daemon=True)
+                self._refresher.start()
+
+    def _refresh_forever(self):
+        self._load_cache()
+        snapshot = self._snapshot
+        if snapshot is not None:
+            # A cached EPG is revalidated when it expires, so restarts in a row don't each crawl Kodi
+            sleep(max(self.CACHE_VALID_TIME - snapshot.age(), 0))
+        while True:
+            if self.refresh():
+                sleep(self.CACHE_VALID_TIME)
+            else:
+                sleep(self.REFRESH_RETRY_TIME)
+
+    def start_events(self):
+        with self._refresher_lock:
+            if self._events is None and self.EVENTS_PORT > 0:
+                log("KodiRpc: Subscribing to Kodi notifications")
+                self._events = KodiEventListener(urlsplit(self.URL).hostname, self.EVENTS_PORT,
+                                                 self._set_player_state, self._labels)
+                self._events.start()
+
+    def _set_player_state(self, playing: bool, paused: bool):
+        self._playing = playing
+        self._paused = paused
+
+    def _assume_player_state(self, playing: bool, paused: bool):
+        # Kodi's notifications are authoritative, guesses only fill in while they are unavailable
+        if self._events is None or not self._events.connected:
+            self._set_player_state(playing, paused)
+
+    def _snapshot_age(self) -> float:
+        snapshot = self._snapshot
+        return snapshot.age() if snapshot is not None else None
+
+    def _get_snapshot(self) -> EpgSnapshot:
+        snapshot = self._snapshot
+        if snapshot is None:
+            self._load_cache()
+            snapshot = self._snapshot
+        if snapshot is None:
+            # Only a cold start waits for Kodi, later refreshes swap in behind the current snapshot
+            self.start_refresher()
+            self._snapshot_ready.wait(self.COLD_START_TIMEOUT)
+            snapshot = self._snapshot
+            if snapshot is None:
+                logw("KodiRpc: No EPG available yet")
+                return EpgSnapshot.build([], [])
+        return snapshot
+
+    def _get_channel_list(self) -> ChannelIndex:
         log("KodiRpc: Getting channel list")
-        if len(self._channelList) > 0:
-            return self._channelList
-        else:
-            log("KodiRpc: Caching channel list")
-            chs = self._get_channels("chs")
-            for ch in chs:
-                if ch['label'][-3:] == ' HD':
-                    ch['label'] = ch['label'][:-3]
-                    if ch['label'].upper() not in self._channelList:
-                        self._channelList[ch['label'].upper()] = ch['channelid']
-            return self._channelList
+        return self._get_snapshot().channels
 
     def _get_channel_id_by_name(self, name: str) -> int:
         log("KodiRpc: Getting channel " + name)
-        if len(self._channelList) == 0:
-            self._get_channel_list()
-        return self._channelList.get(name)
-
-    def _get_channel_broadcasts(self, name: str) -> list:
-        log("KodiRpc: Getting broadcasts of " + name)
-        channel_id = self._get_channel_id_by_name(name)
-        if channel_id is not None:
-            rpc_call = self._build_json("PVR.GetBroadcasts", "gbrd", {'channelid': channel_id,
-                                                                      'properties': ['starttime']})
-            response = requests.post(url=self.URL, data=rpc_call).json()
-            if response is None:
-                logw("KodiRpc: Kodi has no broadcasts for this channel")
-                return []
-            else:
-                return response['result'].get('broadcasts')
-        else:
-            logw("KodiRpc: Channel does not exist")
-            return []
-
-    def _get_next_broadcasts(self, name: str) -> list:
-        log("KodiRpc: Getting next broadcasts of " + name)
-        broadcasts = self._get_channel_broadcasts(name)
-        if broadcasts is not None:
-            return list(filter(
-                lambda x: datetime.strptime(x['starttime'], '%Y-%m-%d %H:%M:%S') >= datetime.now() - timedelta(days=1),
-                broadcasts))
-        else:
-            return []
-
-    def _get_all_next_broadcasts(self) -> list:
-        log("KodiRpc: Getting all next broadcasts")
-        if len(self._channelList) == 0:
-            self._get_channel_list()
-        if len(self._broadcastsList) == 0:
-            log("KodiRpc: Caching broadcasts...")
-            for ch in self._channelList:
-                self._broadcastsList.extend(self._get_next_broadcasts(ch))
-        else:
-            self._broadcastsList = list(filter(
-                lambda x: datetime.strptime(x['starttime'], '%Y-%m-%d %H:%M:%S') >= datetime.now(),
-                self._broadcastsList))
-        return self._broadcastsList
+        return self._get_channel_list().lookup(name)
 
     def play_pause(self) -> bool:
         log("KodiRpc: Play/pause request")
         rpc_call = self._build_json("Input.ExecuteAction", "plps", {'action': 'playpause'})
-        response = requests.post(url=self.URL, data=rpc_call).json()
-        self._paused = not self._paused
-        return response.get('result') == 'OK'
+        response = self._post(rpc_call)
+        if response.get('result') == 'OK':
+            self._assume_player_state(self._playing, not self._paused)
+            return True
+        return False
 
     def get_channel_names(self) -> list:
         log("KodiRpc: Getting channel names")
-        if len(self._channelList) == 0:
-            self._get_channels("chs")
-        return list(self._channelList.keys())
+        return self._get_channel_list().names()
 
     def play_channel(self, channel_name: str) -> bool:
         log("KodiRpc: Request to play " + channel_name)
-        channel_id = self._get_channel_id_by_name(channel_name.upper())
+        channel_id = self._get_channel_id_by_name(channel_name)
         if channel_id is None:
             logw("KodiRpc: Channel not found")
             return False
-        else:
-            self._playing = True
-            self._paused = False
-            return self._play_channel("playch", channel_id)
+        elif self._play_channel("playch", channel_id):
+            self._assume_player_state(True, False)
+            return True
+        return False
 
     def stop(self) -> bool:
         log("KodiRpc: Request to stop")
@@ -173,19 +307,22 @@ class KodiRpc:
             return False
         else:
             rpc_call = self._build_json("Input.ExecuteAction", "stp", {'action': 'stop'})
-            response = requests.post(url=self.URL, data=rpc_call).json()
+            response = self._post(rpc_call)
             if response.get('result') == 'OK':
-                self._playing = False
+                self._assume_player_state(False, False)
                 return True
             else:
                 return False
 
+    def get_guide(self) -> EpgSnapshot:
+        log("KodiRpc: Getting EPG")
+        return self._get_snapshot()
+
     def get_next_time(self, name: str) -> datetime:
         log("KodiRpc: Getting next time schedule for " + name)
-        self._get_all_next_broadcasts()
-        for br in self._broadcastsList:
-            if br['label'].upper() == name.upper():
-                return datetime.strptime(br['starttime'], '%Y-%m-%d %H:%M:%S')+timedelta(days=1)
+        start = self._get_snapshot().next_start(name, datetime.now())
+        if start is not None:
+            return start + timedelta(days=1)
 
     def is_playing(self):
         log("KodiRpc: Getting playing status")
@@ -0,0 +1,117 @@
+import codecs
+import socket
+from json import JSONDecoder, dumps as dictstr
+from logging import debug as log, warning as logw
+from threading import Thread
+from time import sleep
+
+from lib.metrics import Metrics
+
+
+# Kodi pushes JSON-RPC notifications over its raw TCP interface (port 9090 by default).
+# Reference: https://kodi.wiki/view/JSON-RPC_API/v9#Notifications_2
+
+
+class KodiEventListener(Thread):
+    PORT: int = 9090
+    CONNECT_TIMEOUT: float = 10.0
+    RECONNECT_MIN_DELAY: float = 1.0
+    RECONNECT_MAX_DELAY: float = 60.0
+    READ_SIZE: int = 65536
+    MAX_BUFFER: int = 4 * 1024 * 1024
+
+    # Notification method -> (playing, paused)
+    PLAYER_STATES: dict = {'Player.OnPlay': (True, False),
+                           'Player.OnResume': (True, False),
+                           'Player.OnAVStart': (True, False),
+                           'Player.OnPause': (True, True),
+                           'Player.OnStop': (False, False),
+                           'System.OnQuit': (False, False),
+                           'System.OnSleep': (False, False)}
+
+    def __init__(self, host: str, port: int, on_state, labels: dict = None):
+        Thread.__init__(self, name="KodiEventListener", daemon=True)
+        self._host = host
+        self._port = port
+        self._on_state = on_state
+        self._decoder = JSONDecoder()
+        self.connected = False
+        Metrics().register_gauge('kodi_events_connected', lambda: int(self.connected), labels)
+        log("KodiEventListener: Created for " + host + ":" + str(port))
+
+    def run(self):
+        delay = self.RECONNECT_MIN_DELAY
+        while True:
+            try:
+                with socket.create_connection((self._host, self._port), timeout=self.CONNECT_TIMEOUT) as sock:
+                    sock.settimeout(None)
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                    log("KodiEventListener: Connected")
+                    self.connected = True
+                    delay = self.RECONNECT_MIN_DELAY
+                    # Notifications sent while disconnected are lost, so ask for the current state first
+                    self._send(sock, "Player.GetActivePlayers", "evgap")
+                    self._listen(sock)
+                    logw("KodiEventListener: Kodi closed the connection")
+            except (OSError, ValueError):
+                logw("KodiEventListener: Kodi notifications unavailable, retrying in " + str(delay) + "s")
+            finally:
+                self.connected = False
+            sleep(delay)
+            delay = min(delay * 2, self.RECONNECT_MAX_DELAY)
+
+    @staticmethod
+    def _send(sock: socket.socket, method: str, request_id: str, params: dict = None):
+        request = {'jsonrpc': '2.0', 'method': method, 'id': request_id}
+        if params is not None:
+            request['params'] = params
+        sock.sendall(dictstr(request).encode('utf-8'))
+
+    def _listen(self, sock: socket.socket):
+        text = codecs.getincrementaldecoder('utf-8')()
+        buffer = ''
+        while True:
+            chunk = sock.recv(self.READ_SIZE)
+            if not chunk:
+                return
+            buffer = self._consume(sock, buffer + text.decode(chunk))
+            if len(buffer) > self.MAX_BUFFER:
+                raise ValueError("Unparseable notification stream")
+
+    def _consume(self, sock: socket.socket, buffer: str) -> str:
+        # The stream is a plain concatenation of JSON objects without delimiters
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position == len(buffer):
+                return ''
+            try:
+                message, position = self._decoder.raw_decode(buffer, position)
+            except ValueError:
+                return buffer[position:]
+            if isinstance(message, dict):
+                self._handle(sock, message)
+
+    def _handle(self, sock: socket.socket, message: dict):
+        method = message.get('method')
+        if method is not None:
+            Metrics().increment('kodi_notifications_total', {'method': method})
+            if method in self.PLAYER_STATES:
+                log("KodiEventListener: " + method)
+                self._on_state(*self.PLAYER_STATES[method])
+            elif method == 'Player.OnSpeedChanged':
+                speed = message.get('params', {}).get('data', {}).get('player', {}).get('speed')
+                if speed is not None:
+                    self._on_state(True, speed == 0)
+        elif message.get('id') == 'evgap':
+            players = message.get('result') or []
+            if len(players) == 0:
+                self._on_state(False, False)
+            else:
+                self._send(sock, "Player.GetProperties", "evgps",
+                           {'playerid': players[0]['playerid'], 'properties': ['speed']})
+        elif message.get('id') == 'evgps':
+            result = message.get('result')
+            if result is not None:
+                self._on_state(True, result.get('speed') == 0)
@@ -0,0 +1,170 @@
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import debug as log, warning as logw
+from threading import Lock, Thread
+from time import perf_counter
+
+from singleton_decorator import singleton
+
+
+class _Timed:
+
+    def __init__(self, metrics, name: str, labels: dict):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._metrics.observe(self._name, perf_counter() - self._start, self._labels)
+        if exc_type is not None:
+            self._metrics.increment(self._name.replace('_seconds', '') + '_errors_total', self._labels)
+        return False
+
+
+@singleton
+class Metrics:
+    LATENCY_BUCKETS: tuple = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._lock = Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+        log("Metrics: Created")
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items())) if labels else ()
+
+    def increment(self, name: str, labels: dict = None, value: float = 1):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, labels: dict = None):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # One counter per bucket plus +Inf, then the sum of observations
+                histogram = [0] * (len(self.LATENCY_BUCKETS) + 1) + [0.0]
+                self._histograms[key] = histogram
+            histogram[bisect_left(self.LATENCY_BUCKETS, seconds)] += 1
+            histogram[-1] += seconds
+
+    def timed(self, name: str, labels: dict = None) -> _Timed:
+        return _Timed(self, name, labels)
+
+    def register_gauge(self, name: str, f: callable, labels: dict = None):
+        log("Metrics: Registering gauge " + name)
+        with self._lock:
+            self._gauges[self._key(name, labels)] = f
+
+    def _read_gauges(self) -> dict:
+        with self._lock:
+            gauges = dict(self._gauges)
+        values = {}
+        for key, f in gauges.items():
+            try:
+                value = f()
+            except Exception:
+                logw("Metrics: Gauge " + key[0] + " failed", exc_info=True)
+                value = None
+            if value is not None:
+                values[key] = value
+        return values
+
+    @staticmethod
+    def _series(key: tuple) -> str:
+        name, labels = key
+        if len(labels) == 0:
+            return name
+        return name + '{' + ','.join(label + '=' + str(value) for label, value in labels) + '}'
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(histogram) for key, histogram in self._histograms.items()}
+        stats = {'counters': {self._series(key): value for key, value in counters.items()},
+                 'gauges': {self._series(key): value for key, value in self._read_gauges().items()},
+                 'histograms': {}}
+        for key, histogram in histograms.items():
+            count = sum(histogram[:-1])
+            stats['histograms'][self._series(key)] = {
+                'count': count,
+                'sum': histogram[-1],
+                'mean': histogram[-1] / count if count > 0 else None,
+                'buckets': {str(bound): cumulative for bound, cumulative in
+                            zip(self.LATENCY_BUCKETS + ('+Inf',), self._cumulative(histogram[:-1]))}}
+        return stats
+
+    @staticmethod
+    def _cumulative(counts: list) -> list:
+        total = 0
+        cumulative = []
+        for count in counts:
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+    @staticmethod
+    def _prometheus_series(name: str, labels: tuple, extra: tuple = ()) -> str:
+        all_labels = labels + extra
+        if len(all_labels) == 0:
+            return name
+        return name + '{' + ','.join(label + '="' + str(value).replace('"', '\\"') + '"'
+                                     for label, value in all_labels) + '}'
+
+    def prometheus(self) -> str:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(histogram) for key, histogram in self._histograms.items()}
+        lines = []
+        typed = set()
+
+        def declare(name: str, kind: str):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE ' + name + ' ' + kind)
+
+        for (name, labels), value in sorted(counters.items()):
+            declare(name, 'counter')
+            lines.append(self._prometheus_series(name, labels) + ' ' + str(value))
+        for (name, labels), value in sorted(self._read_gauges().items()):
+            declare(name, 'gauge')
+            lines.append(self._prometheus_series(name, labels) + ' ' + str(value))
+        for (name, labels), histogram in sorted(histograms.items()):
+            declare(name, 'histogram')
+            cumulative = self._cumulative(histogram[:-1])
+            for bound, count in zip(self.LATENCY_BUCKETS + ('+Inf',), cumulative):
+                lines.append(self._prometheus_series(name + '_bucket', labels, (('le', bound),)) + ' ' + str(count))
+            lines.append(self._prometheus_series(name + '_sum', labels) + ' ' + str(histogram[-1]))
+            lines.append(self._prometheus_series(name + '_count', labels) + ' ' + str(cumulative[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+def serve_prometheus(port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            body = Metrics().prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name="MetricsHTTPServer", daemon=True).start()
+    log("Metrics: Serving Prometheus metrics on " + host + ":" + str(port))
+    return server
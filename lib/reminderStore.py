@@ -0,0 +1,273 @@
+import json
+import os
+import pickle
+import sqlite3
+from bisect import bisect_left, insort
+from datetime import time
+from logging import debug as log, warning as logw
+from os.path import abspath, dirname, exists, join
+from typing import NamedTuple
+
+MINUTES_PER_WEEK = 7 * 24 * 60
+
+
+def minute_of_week(weekday: int, hour: int, minute: int) -> int:
+    return (weekday - 1) * 24 * 60 + hour * 60 + minute
+
+
+class Reminder(NamedTuple):
+    time: time
+    weekday: int
+    concept: int
+    id: str
+
+    @property
+    def minute_of_week(self) -> int:
+        return minute_of_week(self.weekday, self.time.hour, self.time.minute)
+
+
+# Reminder stores are not thread-safe, ReminderData serializes every call to them.
+# Lists of reminders are always returned by minute of the week, then id.
+
+
+class MemoryReminderStore:
+
+    def __init__(self, directory: str = ''):
+        self._savefile = join(directory, 'reminders.sav')
+        self._journal_file = join(directory, 'reminders.journal')
+        self._reminders = {}
+        self._index = []
+        self._journal = None
+
+    def has_data(self) -> bool:
+        return exists(self._savefile) or exists(self._journal_file)
+
+    def load(self):
+        self._reminders = {}
+        if exists(self._savefile):
+            log("MemoryReminderStore: Data found, loading...")
+            with open(self._savefile, 'rb') as savefile:
+                saved = pickle.load(savefile)
+            self._reminders = {r_id: Reminder(*reminder) for r_id, reminder in saved.items()}
+        self._replay_journal()
+        log("MemoryReminderStore: Indexing...")
+        self._index = sorted((reminder.minute_of_week, r_id) for r_id, reminder in self._reminders.items())
+
+    def _journal_append(self, record: dict):
+        if self._journal is None:
+            self._journal = open(self._journal_file, 'a')
+        self._journal.write(json.dumps(record) + '\n')
+
+    def _journal_sync(self):
+        if self._journal is not None:
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+
+    def _replay_journal(self):
+        if not exists(self._journal_file):
+            return
+        log("MemoryReminderStore: Replaying journal")
+        replayed = 0
+        with open(self._journal_file, 'r') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logw("MemoryReminderStore: Skipping unreadable journal entry")
+                    continue
+                if record['op'] == 'ADD':
+                    r_time = time(record['hour'], record['minute'])
+                    self._reminders[record['id']] = Reminder(r_time, record['weekday'], record['concept'],
+                                                             record['id'])
+                else:
+                    self._reminders.pop(record['id'], None)
+                replayed += 1
+        log("MemoryReminderStore: Replayed " + str(replayed) + " journal entries")
+
+    def add(self, reminders: list):
+        for reminder in reminders:
+            self._journal_append({'op': 'ADD', 'id': reminder.id, 'hour': reminder.time.hour,
+                                  'minute': reminder.time.minute, 'weekday': reminder.weekday,
+                                  'concept': reminder.concept})
+            self._reminders[reminder.id] = reminder
+        self._journal_sync()
+        if len(reminders) == 1:
+            insort(self._index, (reminders[0].minute_of_week, reminders[0].id))
+        else:
+            self._index.extend((reminder.minute_of_week, reminder.id) for reminder in reminders)
+            self._index.sort()
+
+    def remove(self, r_id: str) -> Reminder:
+        reminder = self._reminders.get(r_id)
+        if reminder is None:
+            return None
+        self._journal_append({'op': 'REMOVE', 'id': r_id})
+        self._journal_sync()
+        del self._reminders[r_id]
+        key = (reminder.minute_of_week, r_id)
+        position = bisect_left(self._index, key)
+        if position < len(self._index) and self._index[position] == key:
+            del self._index[position]
+        return reminder
+
+    def get(self, r_id: str) -> Reminder:
+        return self._reminders.get(r_id)
+
+    def __len__(self) -> int:
+        return len(self._reminders)
+
+    def all(self) -> list:
+        return [self._reminders[r_id] for _, r_id in self._index]
+
+    def between(self, start: int, end: int) -> list:
+        first = bisect_left(self._index, (start,))
+        last = bisect_left(self._index, (end,))
+        if start <= end:
+            keys = self._index[first:last]
+        else:
+            # The range wraps around the end of the week
+            keys = self._index[first:] + self._index[:last]
+        return [self._reminders[r_id] for _, r_id in keys]
+
+    def upcoming(self, start: int, count: int) -> list:
+        first = bisect_left(self._index, (start,))
+        # Only the keys returned are copied, wrapping around to the start of the week, never past first
+        keys = self._index[first:first + count]
+        keys += self._index[:min(first, count - len(keys))]
+        return [self._reminders[r_id] for _, r_id in keys]
+
+    def by_concept(self, concept: int) -> list:
+        return [self._reminders[r_id] for _, r_id in self._index if self._reminders[r_id].concept == concept]
+
+    @staticmethod
+    def _fsync_dir(path: str):
+        fd = os.open(dirname(abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def save(self) -> bool:
+        if not exists(self._journal_file) and exists(self._savefile):
+            return False
+        # Compaction: atomically replace the snapshot, then start an empty journal
+        tmp_file = self._savefile + '.tmp'
+        with open(tmp_file, 'wb') as savefile:
+            pickle.dump({r_id: tuple(reminder) for r_id, reminder in self._reminders.items()}, savefile)
+            savefile.flush()
+            os.fsync(savefile.fileno())
+        os.replace(tmp_file, self._savefile)
+        self._fsync_dir(self._savefile)
+        self.discard_journal()
+        return True
+
+    def discard_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if exists(self._journal_file):
+            os.remove(self._journal_file)
+
+
+class SqliteReminderStore:
+    SCHEMA = ("CREATE TABLE IF NOT EXISTS reminders (id TEXT PRIMARY KEY, minute_of_week INTEGER NOT NULL, "
+              "weekday INTEGER NOT NULL, hour INTEGER NOT NULL, minute INTEGER NOT NULL, concept INTEGER NOT NULL)",
+              "CREATE INDEX IF NOT EXISTS reminders_by_minute ON reminders (minute_of_week, id)",
+              "CREATE INDEX IF NOT EXISTS reminders_by_concept ON reminders (concept, minute_of_week, id)")
+    COLUMNS = "hour, minute, weekday, concept, id"
+
+    def __init__(self, directory: str = ''):
+        self._path = join(directory, 'reminders.db')
+        self._directory = directory
+        self._db = None
+
+    def _connect(self):
+        log("SqliteReminderStore: Opening " + self._path)
+        # Other processes can read the store while it is written thanks to WAL
+        self._db = sqlite3.connect(self._path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            for statement in self.SCHEMA:
+                self._db.execute(statement)
+
+    def load(self):
+        if self._db is None:
+            self._connect()
+        legacy = MemoryReminderStore(self._directory)
+        if legacy.has_data():
+            self._migrate(legacy)
+
+    def _migrate(self, legacy: MemoryReminderStore):
+        log("SqliteReminderStore: Migrating pickled reminders")
+        legacy.load()
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO reminders VALUES (?, ?, ?, ?, ?, ?)",
+                                 [self._row(reminder) for reminder in legacy.all()])
+        # The pickle is kept aside, it is not read again once migrated
+        legacy_file = join(self._directory, 'reminders.sav')
+        if exists(legacy_file):
+            os.replace(legacy_file, legacy_file + '.migrated')
+        legacy.discard_journal()
+        log("SqliteReminderStore: Migrated " + str(len(legacy)) + " reminders")
+
+    @staticmethod
+    def _row(reminder: Reminder) -> tuple:
+        return (reminder.id, reminder.minute_of_week, reminder.weekday, reminder.time.hour, reminder.time.minute,
+                reminder.concept)
+
+    @staticmethod
+    def _reminder(row: tuple) -> Reminder:
+        hour, minute, weekday, concept, r_id = row
+        return Reminder(time(hour, minute), weekday, concept, r_id)
+
+    def _select(self, where: str = "", parameters: tuple = ()) -> list:
+        rows = self._db.execute("SELECT " + self.COLUMNS + " FROM reminders " + where, parameters).fetchall()
+        return [self._reminder(row) for row in rows]
+
+    def add(self, reminders: list):
+        with self._db:
+            self._db.executemany("INSERT INTO reminders VALUES (?, ?, ?, ?, ?, ?)",
+                                 [self._row(reminder) for reminder in reminders])
+
+    def remove(self, r_id: str) -> Reminder:
+        reminder = self.get(r_id)
+        if reminder is not None:
+            with self._db:
+                self._db.execute("DELETE FROM reminders WHERE id = ?", (r_id,))
+        return reminder
+
+    def get(self, r_id: str) -> Reminder:
+        reminders = self._select("WHERE id = ?", (r_id,))
+        return reminders[0] if len(reminders) > 0 else None
+
+    def __len__(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM reminders").fetchone()[0]
+
+    def all(self) -> list:
+        return self._select("ORDER BY minute_of_week, id")
+
+    def between(self, start: int, end: int) -> list:
+        if start <= end:
+            return self._select("WHERE minute_of_week >= ? AND minute_of_week < ? ORDER BY minute_of_week, id",
+                                (start, end))
+        return (self._select("WHERE minute_of_week >= ? ORDER BY minute_of_week, id", (start,))
+                + self._select("WHERE minute_of_week < ? ORDER BY minute_of_week, id", (end,)))
+
+    def upcoming(self, start: int, count: int) -> list:
+        reminders = self._select("WHERE minute_of_week >= ? ORDER BY minute_of_week, id LIMIT ?", (start, count))
+        if len(reminders) < count:
+            reminders += self._select("WHERE minute_of_week < ? ORDER BY minute_of_week, id LIMIT ?",
+                                      (start, count - len(reminders)))
+        return reminders
+
+    def by_concept(self, concept: int) -> list:
+        return self._select("WHERE concept = ? ORDER BY minute_of_week, id", (concept,))
+
+    def save(self) -> bool:
+        # Every change is already committed, saving only folds the WAL back into the database
+        self._db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return True
+
+
+STORES = {'memory': MemoryReminderStore, 'sqlite': SqliteReminderStore}
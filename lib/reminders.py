@@ -1,26 +1,71 @@
 import json
-import pickle
-from datetime import datetime
+import os
+from datetime import datetime, timedelta
+from functools import lru_cache
 from logging import debug as log, warning as logw
-from os.path import exists
-from threading import Timer
+from os.path import join
+from threading import RLock, Timer
 from typing import Union, NoReturn
 from uuid import uuid4 as gen_uuid
 
 from singleton_decorator import singleton
 
+from lib.metrics import Metrics
+from lib.reminderStore import MINUTES_PER_WEEK, STORES, Reminder, minute_of_week
+
+VECTORIZE_THRESHOLD = 64
+
+
+@lru_cache(maxsize=None)
+def _numpy():
+    # NumPy is optional and slow to import, so it is only loaded for the first large batch
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def next_fire_offsets(minutes: list, now: datetime) -> list:
+    # A reminder due in the current minute has already fired, so it is a week away
+    now_minute = minute_of_week(now.isoweekday(), now.hour, now.minute)
+    numpy = _numpy() if len(minutes) >= VECTORIZE_THRESHOLD else None
+    if numpy is not None:
+        deltas = (numpy.asarray(minutes, dtype=numpy.int64) - now_minute) % MINUTES_PER_WEEK
+        deltas[deltas == 0] = MINUTES_PER_WEEK
+        return (deltas * 60000).tolist()
+    return [((minute - now_minute) % MINUTES_PER_WEEK or MINUTES_PER_WEEK) * 60000 for minute in minutes]
+
+
+def last_fire_offsets(minutes: list, now: datetime) -> list:
+    # Milliseconds since the start of the latest occurrence, 0 for reminders due in the current minute
+    now_minute = minute_of_week(now.isoweekday(), now.hour, now.minute)
+    numpy = _numpy() if len(minutes) >= VECTORIZE_THRESHOLD else None
+    if numpy is not None:
+        return (((now_minute - numpy.asarray(minutes, dtype=numpy.int64)) % MINUTES_PER_WEEK) * 60000).tolist()
+    return [((now_minute - minute) % MINUTES_PER_WEEK) * 60000 for minute in minutes]
+
 
 @singleton
 class ReminderData:
+    SITES_DIRECTORY: str = 'sites'
+    STORE: str = 'memory'
 
-    def __init__(self):
-        self._REMINDER_SAVEFILE = 'reminders.sav'
+    def __init__(self, site: str = None):
+        # Every site keeps its own shard of reminders in a directory of its own
+        directory = '' if site is None else join(self.SITES_DIRECTORY, site)
+        if len(directory) > 0:
+            os.makedirs(directory, exist_ok=True)
         self._REMINDER_AUTOSAVE_INTERVAL_SECONDS = 600
         self._NON_REPEATING_REMINDER_CONCEPTS = [7]
-        self._reminders = []
-        self._db_reminders = {}
+        self._store = STORES[self.STORE](directory)
+        self._heartbeat_file = join(directory, 'reminders.heartbeat')
         self._add_callbacks = {}
         self._remove_callbacks = {}
+        self._lock = RLock()
+        self._version = 0
+        self._id_payload = (-1, None)
+        Metrics().register_gauge('reminder_store_size', self._size, {'site': site} if site is not None else None)
         log("ReminderData: Created")
         self.load()
         self._autosave()
@@ -28,11 +73,12 @@ class ReminderData:
     def _autosave(self):
         log("ReminderData: Re-enabling autosave")
         self._timer = Timer(self._REMINDER_AUTOSAVE_INTERVAL_SECONDS, self.save)
+        self._timer.daemon = True
         self._timer.start()
 
-    def _sort(self):
-        log("ReminderData: Sorting...")
-        self._reminders.sort(key=lambda tup: str(tup[1]) + str(tup[0]), reverse=True)
+    def _size(self) -> int:
+        with self._lock:
+            return len(self._store)
 
     def register_add_callback(self, f: callable) -> str:
         log("ReminderData: Registering new add callback")
@@ -50,27 +96,48 @@ class ReminderData:
             logw("ReminderData: Callback not found")
             return False
 
-    def add_reminder(self, hour: int, minute: int, weekday: int, concept: int) -> Union[str, NoReturn]:
-        log("ReminderData: Adding reminder...")
+    @staticmethod
+    def _create_reminder(hour: int, minute: int, weekday: int, concept: int) -> Union[Reminder, NoReturn]:
         if 0 < hour < 25 and -1 < minute < 61 and 0 < weekday < 8:
             str_time = str(hour) + ":" + str(minute) + ":00"
             r_time = datetime.strptime(str_time, '%H:%M:%S').time()
             r_id = str(gen_uuid())
-            reminder = (r_time, weekday, concept, r_id)
             log("ReminderData: Created reminder " + r_id)
-            self._reminders.append(reminder)
-            log(self._reminders)
-            self._db_reminders[r_id] = reminder
-            self._sort()
+            return Reminder(r_time, weekday, concept, r_id)
+
+    def add_reminder(self, hour: int, minute: int, weekday: int, concept: int) -> Union[str, NoReturn]:
+        log("ReminderData: Adding reminder...")
+        reminder = self._create_reminder(hour, minute, weekday, concept)
+        if reminder is not None:
+            with self._lock:
+                self._store.add([reminder])
+                self._version += 1
             log("ReminderData: Executing add callbacks")
             for f in self._add_callbacks.values():
-                f(r_id)
-            return r_id
+                f(reminder.id)
+            return reminder.id
+
+    def add_reminders(self, entries: list) -> list:
+        log("ReminderData: Adding " + str(len(entries)) + " reminders...")
+        reminders = [self._create_reminder(hour, minute, weekday, concept)
+                     for hour, minute, weekday, concept in entries]
+        with self._lock:
+            self._store.add([reminder for reminder in reminders if reminder is not None])
+            self._version += 1
+        log("ReminderData: Executing add callbacks")
+        r_ids = [reminder.id if reminder is not None else None for reminder in reminders]
+        for r_id in r_ids:
+            if r_id is not None:
+                for f in self._add_callbacks.values():
+                    f(r_id)
+        return r_ids
 
     def repeat_reminder(self, r_id: str) -> bool:
         log("ReminderData: Repeating reminder " + r_id)
-        if r_id in self._db_reminders:
-            if self._db_reminders[r_id][2] in self._NON_REPEATING_REMINDER_CONCEPTS:
+        with self._lock:
+            reminder = self._store.get(r_id)
+        if reminder is not None:
+            if not self.is_repeating(reminder):
                 log("ReminderData: Non-repeating reminder, ignoring...")
                 return True
             for f in self._add_callbacks.values():
@@ -98,10 +165,11 @@ class ReminderData:
 
     def remove_reminder(self, r_id: str) -> bool:
         log("ReminderData: Removing reminder " + r_id)
-        if r_id in self._db_reminders:
-            reminder = self._db_reminders[r_id]
-            self._db_reminders.pop(r_id)
-            self._reminders.remove(reminder)
+        with self._lock:
+            reminder = self._store.remove(r_id)
+            if reminder is not None:
+                self._version += 1
+        if reminder is not None:
             log("ReminderData: Removed " + r_id)
             log("ReminderData: Executing remove callbacks")
             for f in self._remove_callbacks.values():
@@ -113,38 +181,48 @@ class ReminderData:
 
     def get_reminder(self, r_id: str) -> Union[tuple, NoReturn]:
         log("ReminderData: Getting reminder " + r_id)
-        if r_id in self._db_reminders:
-            return self._db_reminders[r_id]
-        else:
+        with self._lock:
+            reminder = self._store.get(r_id)
+        if reminder is None:
             logw("ReminderData: Reminder not found")
+        return reminder
+
+    def get_version(self) -> int:
+        return self._version
 
     def get_all_reminders(self) -> list:
         log("ReminderData: Getting all reminders")
-        return self._reminders
+        with self._lock:
+            return self._store.all()[::-1]
+
+    def get_reminders_between(self, start: int, end: int) -> list:
+        log("ReminderData: Getting reminders between minutes " + str(start) + " and " + str(end) + " of the week")
+        with self._lock:
+            return self._store.between(start, end)
+
+    def get_reminders_by_concept(self, concept: int) -> list:
+        log("ReminderData: Getting reminders of concept " + str(concept))
+        with self._lock:
+            return self._store.by_concept(concept)
 
     def save(self):
         log("ReminderData: Saving...")
         try:
-            print(self._db_reminders)
-            print(self._reminders)
-
-            with open(self._REMINDER_SAVEFILE, 'wb') as savefile:
-                pickle.dump(self._db_reminders, savefile)
-        except:
-            import traceback
-            traceback.print_exc()
+            with self._lock, Metrics().timed('reminder_save_seconds'):
+                if self._store.save():
+                    log("ReminderData: Saved " + str(len(self._store)) + " reminders")
+                else:
+                    log("ReminderData: No changes since last save")
+        except Exception:
+            logw("ReminderData: Error saving reminders", exc_info=True)
         self._autosave()
 
     def load(self):
         log("ReminderData: Loading data")
-        if exists(self._REMINDER_SAVEFILE):
-            log("ReminderData: Data found, loading...")
-            with open(self._REMINDER_SAVEFILE, 'rb') as savefile:
-                saved = pickle.load(savefile)
-                self._db_reminders = saved
-                self._reminders = list(self._db_reminders.values())
-                log("Reminder data: Found " + str(len(self._reminders)) + " reminders")
-                self._sort()
+        with self._lock, Metrics().timed('reminder_load_seconds'):
+            self._store.load()
+            log("Reminder data: Found " + str(len(self._store)) + " reminders")
+            self._version += 1
 
     def get_seconds_to(self, r_id: str) -> float:
         log("ReminderData: Getting seconds to " + r_id)
@@ -157,36 +235,67 @@ class ReminderData:
             return -1
 
     @staticmethod
-    def _get_ms_time(time, weekday: int) -> int:
+    def _get_ms_time(time, weekday: int, now: datetime = None) -> int:
         log("ReminderData: Getting ms to time")
-        now = datetime.now()
-        now_weekday = now.isoweekday()
-        now_time = now.time()
-        if time.hour >= now_time.hour:
-            delta_sec = (time.hour - now_time.hour) * 3600
-        else:
-            delta_sec = (now_time.hour - time.hour) * -3600
-        if time.minute >= now_time.minute:
-            delta_sec += (time.minute - now_time.minute) * 60
-        else:
-            delta_sec -= (now_time.minute - time.minute) * 60
-        if weekday == now_weekday:
-            if time <= now_time:
-                delta_sec += 24 * 7 * 3600
-        else:
-            if weekday < now_weekday:
-                delta_sec += 24 * (weekday - now_weekday + 7) * 3600
-            else:
-                delta_sec += 24 * (weekday - now_weekday) * 3600
-        delta_ms = delta_sec * 1000
+        delta_ms = next_fire_offsets([minute_of_week(weekday, time.hour, time.minute)], now or datetime.now())[0]
         log("ReminderData: Got " + str(delta_ms) + " ms")
         return delta_ms
 
+    def get_next_fires(self, now: datetime = None) -> list:
+        log("ReminderData: Getting next firing of every reminder")
+        with self._lock:
+            reminders = self.get_all_reminders()
+        offsets = next_fire_offsets([reminder.minute_of_week for reminder in reminders], now or datetime.now())
+        return list(zip(offsets, reminders))
+
+    def get_missed_fires(self, since: datetime, now: datetime = None) -> list:
+        log("ReminderData: Getting reminders missed since " + str(since))
+        now = now or datetime.now()
+        current_minute = now.replace(second=0, microsecond=0)
+        with self._lock:
+            reminders = self.get_all_reminders()
+        missed = []
+        for offset, reminder in zip(last_fire_offsets([reminder.minute_of_week for reminder in reminders], now),
+                                    reminders):
+            if current_minute - timedelta(milliseconds=offset) > since:
+                missed.append((offset, reminder))
+        # Most recently missed first
+        missed.sort(key=lambda fire: fire[0])
+        return missed
+
+    def is_repeating(self, reminder: Reminder) -> bool:
+        return reminder.concept not in self._NON_REPEATING_REMINDER_CONCEPTS
+
+    def get_heartbeat(self) -> datetime:
+        try:
+            with open(self._heartbeat_file, 'r') as heartbeat:
+                return datetime.fromtimestamp(float(heartbeat.read()))
+        except (OSError, ValueError):
+            return None
+
+    def heartbeat(self, timestamp: float = None):
+        # Written whenever reminders fire, so a restart knows which firings it missed
+        tmp_file = self._heartbeat_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as heartbeat:
+                heartbeat.write(repr(timestamp if timestamp is not None else datetime.now().timestamp()))
+            os.replace(tmp_file, self._heartbeat_file)
+        except OSError:
+            logw("ReminderData: Could not write heartbeat", exc_info=True)
+
+    def get_next_reminders(self, count: int = 1, now: datetime = None) -> list:
+        log("ReminderData: Getting next " + str(count) + " reminders")
+        now = now or datetime.now()
+        with self._lock:
+            # Reminders due in the current minute already fired, the next ones start after it
+            reminders = self._store.upcoming(minute_of_week(now.isoweekday(), now.hour, now.minute) + 1, count)
+        offsets = next_fire_offsets([reminder.minute_of_week for reminder in reminders], now)
+        return list(zip(offsets, reminders))
+
     def jsonify(self) -> str:
         log("ReminderData: JSONifying")
         rec_list = []
-        for reminder in self._reminders:
-            ms = self._get_ms_time(reminder[0], reminder[1])
+        for ms, reminder in self.get_next_fires():
             concept = reminder[2]
             r_dict = {'tiempo': ms, 'sonido': concept}
             rec_list.append(r_dict)
@@ -198,13 +307,19 @@ class ReminderData:
 
     def jsonify_id(self) -> str:
         log("IDReminderData: JSONifying")
-        rec_list = []
-        for reminder in self._reminders:
-             #ms = self._get_ms_time(reminder[0], reminder[1])
-            concept = reminder[2]
-            #pasar time a ms
-            r_dict = {"tiempo": (reminder[0].hour*1000*60*60 + reminder[0].minute*60*1000) , "dia": reminder[1],  "sonido": concept, "id": reminder[3] }
-            rec_list.append(r_dict)
-        json_dict = {'recordatorios': rec_list}
-        return json.dumps(json_dict)
-       
+        with self._lock:
+            version, payload = self._id_payload
+            if version == self._version:
+                log("IDReminderData: Serving cached version " + str(version))
+                return payload
+            rec_list = []
+            for reminder in self.get_all_reminders():
+                 #ms = self._get_ms_time(reminder[0], reminder[1])
+                concept = reminder[2]
+                #pasar time a ms
+                r_dict = {"tiempo": (reminder[0].hour*1000*60*60 + reminder[0].minute*60*1000) , "dia": reminder[1],  "sonido": concept, "id": reminder[3] }
+                rec_list.append(r_dict)
+            json_dict = {'recordatorios': rec_list}
+            payload = json.dumps(json_dict)
+            self._id_payload = (self._version, payload)
+            return payload
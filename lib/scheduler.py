@@ -0,0 +1,116 @@
+import heapq
+from itertools import count
+from logging import debug as log, warning as logw
+from threading import Condition, Thread
+from time import time
+
+from singleton_decorator import singleton
+
+
+@singleton
+class TimerScheduler:
+    MAX_WAIT_SECONDS: float = 60.0
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._cancelled = 0
+        self._counter = count()
+        self._condition = Condition()
+        self._thread = None
+        log("TimerScheduler: Created")
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _ensure_running(self):
+        if self._thread is None:
+            log("TimerScheduler: Starting scheduler thread")
+            self._thread = Thread(target=self._run, name="TimerScheduler", daemon=True)
+            self._thread.start()
+
+    def schedule(self, key, deadline: float, callback: callable):
+        log("TimerScheduler: Scheduling " + str(key) + " at " + str(deadline))
+        # Entries are [deadline, sequence, key, callback]; a cancelled entry loses its key
+        entry = [deadline, next(self._counter), key, callback]
+        with self._condition:
+            self._discard(key)
+            self._entries[key] = entry
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                self._condition.notify()
+            self._ensure_running()
+
+    def schedule_many(self, deadlines: list, callback: callable):
+        log("TimerScheduler: Scheduling " + str(len(deadlines)) + " timers")
+        # A whole batch of (key, deadline) pairs costs one lock acquisition and one heapify
+        with self._condition:
+            for key, deadline in deadlines:
+                self._discard(key)
+                entry = [deadline, next(self._counter), key, callback]
+                self._entries[key] = entry
+                self._heap.append(entry)
+            heapq.heapify(self._heap)
+            self._condition.notify()
+            self._ensure_running()
+
+    def schedule_in(self, key, seconds: float, callback: callable):
+        self.schedule(key, time() + seconds, callback)
+
+    def cancel(self, key) -> bool:
+        log("TimerScheduler: Cancelling " + str(key))
+        with self._condition:
+            return self._discard(key)
+
+    def deadline(self, key) -> float:
+        entry = self._entries.get(key)
+        return entry[0] if entry is not None else None
+
+    def _discard(self, key) -> bool:
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        entry[2] = None
+        self._cancelled += 1
+        if self._cancelled > len(self._entries):
+            self._heap = [e for e in self._heap if e[2] is not None]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+        return True
+
+    def _pop_due(self) -> list:
+        due = []
+        now = time()
+        while len(self._heap) > 0 and self._heap[0][0] <= now:
+            entry = heapq.heappop(self._heap)
+            if entry[2] is None:
+                self._cancelled -= 1
+            else:
+                self._entries.pop(entry[2])
+                due.append(entry)
+        return due
+
+    def _run(self):
+        while True:
+            with self._condition:
+                due = self._pop_due()
+                while len(due) == 0:
+                    if len(self._heap) > 0:
+                        wait = min(self._heap[0][0] - time(), self.MAX_WAIT_SECONDS)
+                    else:
+                        wait = self.MAX_WAIT_SECONDS
+                    self._condition.wait(max(wait, 0.0))
+                    due = self._pop_due()
+            self._fire(due)
+
+    @staticmethod
+    def _fire(due: list):
+        batches = {}
+        for deadline, _, key, callback in due:
+            batches.setdefault((deadline, callback), []).append(key)
+        for (deadline, callback), keys in batches.items():
+            log("TimerScheduler: Firing " + str(len(keys)) + " timers due at " + str(deadline))
+            try:
+                callback(keys)
+            except Exception:
+                logw("TimerScheduler: Timer callback failed", exc_info=True)
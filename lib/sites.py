@@ -0,0 +1,52 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+from json import load as json_load
+from logging import debug as log
+from os.path import basename, join
+
+from lib.aio import AsyncKodiRpc
+from lib.kodiCtrl import KodiRpc
+from lib.reminders import ReminderData
+
+# Topics are laid out as /dsh/<site>/..., the single-site orchestrator serves the "damaso" site
+_SITE_SEGMENT = re.compile(r'^/dsh/[^/]+/')
+
+
+def site_topic(channel: str, site=None) -> str:
+    if site is None:
+        return channel
+    return _SITE_SEGMENT.sub('/dsh/' + site.name + '/', channel)
+
+
+def site_pattern(channel: str) -> str:
+    return _SITE_SEGMENT.sub('/dsh/+/', channel)
+
+
+class Site:
+
+    def __init__(self, name: str, kodi_url: str = None, kodi_events_port: int = None, with_reminders: bool = True):
+        if len(name) == 0 or '/' in name or '+' in name or '#' in name:
+            raise ValueError("Invalid site name " + repr(name))
+        self.name = name
+        # A process that does not own the reminders must not load them, it would save a stale copy over them
+        self.reminders = ReminderData.__wrapped__(name) if with_reminders else None
+        cache_file = KodiRpc.__wrapped__.EPG_CACHE_FILE
+        if len(cache_file) > 0:
+            cache_file = join(ReminderData.__wrapped__.SITES_DIRECTORY, name, basename(cache_file))
+        self.kodi = KodiRpc.__wrapped__(kodi_url, kodi_events_port, name, cache_file)
+        self.async_kodi = AsyncKodiRpc.__wrapped__(self.kodi)
+        log("Site: Created " + name)
+
+    def topic(self, channel: str) -> str:
+        return site_topic(channel, self)
+
+
+def load_sites(path: str, parallelism: int = 8, with_reminders: bool = True) -> list:
+    # {"site": {"kodi": "http://host:8080/jsonrpc", "kodi_events_port": 9090}, ...}
+    log("Sites: Loading " + path)
+    with open(path, 'r') as sites_json:
+        config = json_load(sites_json)
+    # Every site loads its own reminder shard, so they are loaded side by side
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        return list(executor.map(lambda item: Site(item[0], item[1].get('kodi'), item[1].get('kodi_events_port'),
+                                                   with_reminders), config.items()))
@@ -0,0 +1,40 @@
+import os
+from contextlib import contextmanager
+from json import dumps
+from logging import debug as log
+from time import perf_counter, time
+
+from lib.communicator import MQTTConnection, MQTTPublisher
+from lib.metrics import Metrics
+
+
+class StartupReport:
+    READY_CHANNEL = "/dsh/damaso/ready"
+
+    def __init__(self):
+        self._started = perf_counter()
+        self._phases = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        log("StartupReport: Starting phase " + name)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self._phases[name] = perf_counter() - start
+            Metrics().observe('startup_phase_seconds', self._phases[name], {'phase': name})
+
+    def announce_on_exit(self):
+        # The broker replaces the ready message if the process dies without disconnecting
+        MQTTConnection().set_will(self.READY_CHANNEL, dumps({'ready': False, 'pid': os.getpid()}), 1, True)
+
+    def publish_ready(self, mode: str):
+        report = {'ready': True,
+                  'mode': mode,
+                  'pid': os.getpid(),
+                  'timestamp': time(),
+                  'phases': self._phases,
+                  'total': perf_counter() - self._started}
+        log("StartupReport: Ready after " + str(report['total']) + "s")
+        MQTTPublisher(self.READY_CHANNEL, qos=1, retain=True).publish(dumps(report))
@@ -0,0 +1,58 @@
+from logging import debug as log, warning as logw
+from queue import Empty, Full, Queue
+from threading import Thread
+from time import time
+
+from lib.communicator import run_handler
+from lib.metrics import Metrics
+
+
+class OrderedWorkerPool:
+    POLICIES = ('block', 'drop_newest', 'drop_oldest')
+
+    def __init__(self, workers: int = 4, queue_size: int = 100, policy: str = 'block'):
+        if policy not in self.POLICIES:
+            raise ValueError("Unknown queue policy " + policy)
+        self._policy = policy
+        self._metrics = Metrics()
+        self._queues = [Queue(maxsize=queue_size) for _ in range(workers)]
+        for worker, queue in enumerate(self._queues):
+            self._metrics.register_gauge('worker_queue_depth', queue.qsize, {'worker': str(worker)})
+            Thread(target=self._work, args=(worker, queue), name="Worker-" + str(worker), daemon=True).start()
+        log("OrderedWorkerPool: Started " + str(workers) + " workers with " + policy + " queues of "
+            + str(queue_size))
+
+    def submit(self, topic: str, action, payload: str):
+        # Every message of a topic goes to the same worker, so its handlers run in arrival order
+        worker = hash(topic) % len(self._queues)
+        queue = self._queues[worker]
+        item = (time(), topic, action, payload)
+        if self._policy == 'block':
+            queue.put(item)
+            return
+        try:
+            queue.put_nowait(item)
+        except Full:
+            if self._policy == 'drop_oldest':
+                # Several MQTT network threads may share a worker in threads mode, so retry until it fits
+                while True:
+                    try:
+                        queue.get_nowait()
+                    except Empty:
+                        pass
+                    try:
+                        queue.put_nowait(item)
+                        break
+                    except Full:
+                        continue
+                logw("OrderedWorkerPool: Worker " + str(worker) + " full, dropped oldest message")
+            else:
+                logw("OrderedWorkerPool: Worker " + str(worker) + " full, dropped message on " + topic)
+            self._metrics.increment('worker_dropped_total', {'topic': topic})
+
+    def _work(self, worker: int, queue: Queue):
+        labels = {'worker': str(worker)}
+        while True:
+            enqueued, topic, action, payload = queue.get()
+            self._metrics.observe('worker_queue_wait_seconds', time() - enqueued, labels)
+            run_handler(topic, action, payload)
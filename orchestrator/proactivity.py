@@ -1,9 +1,12 @@
 from json import dumps
 from logging import debug as log
-from threading import Thread, Timer
+from threading import Thread
 
 from lib.communicator import MQTTDaemon, MQTTPublisher
+from lib.debounce import Debouncer
 from lib.kodiCtrl import KodiRpc
+from lib.scheduler import TimerScheduler
+from lib.sites import Site, site_topic
 from orchestrator.tv import TVPauseParallelService, TVStopParallelService
 
 
@@ -11,9 +14,11 @@ class ProactiveAwakenParallelService(Thread):
     LISTEN_CHANNEL = "/dsh/damaso/proactive/awaken"
     ANSWER_CHANNEL = "hermes/hotword/hey_snips/detected"
 
-    def __init__(self):
+    def __init__(self, site: Site = None):
         Thread.__init__(self)
+        self._site_id = 'default' if site is None else site.name
         self._publisher = MQTTPublisher(self.ANSWER_CHANNEL)
+        self.LISTEN_CHANNEL = site_topic(self.LISTEN_CHANNEL, site)
         log("ProactiveAwakenParallelService: Created")
 
     def run(self):
@@ -22,7 +27,7 @@ class ProactiveAwakenParallelService(Thread):
 
     def interact(self, message):
         log("ProactiveAwakenParallelService: Got message " + message)
-        self._publisher.publish(dumps({'siteId': 'default', 'modelId': 'hey_snips'}))
+        self._publisher.publish(dumps({'siteId': self._site_id, 'modelId': 'hey_snips'}))
 
 
 class ProactiveManagementParallelService(Thread):
@@ -31,14 +36,21 @@ class ProactiveManagementParallelService(Thread):
     PAUSE_CHANNEL = TVPauseParallelService.LISTEN_CHANNEL
     STOP_CHANNEL = TVStopParallelService.LISTEN_CHANNEL
     TIMER_DEADLINE = 5.0 * 60.0
+    ON_HOLD = 0.5
+    OFF_HOLD = 5.0
 
-    def __init__(self):
+    def __init__(self, site: Site = None):
         Thread.__init__(self)
-        self._kodi = KodiRpc()
-        self._timer = None
-        self._awakener = MQTTPublisher(self.WAKEUP_CHANNEL)
-        self._pauser = MQTTPublisher(self.PAUSE_CHANNEL)
-        self._stopper = MQTTPublisher(self.STOP_CHANNEL)
+        self._kodi = KodiRpc() if site is None else site.kodi
+        self._scheduler = TimerScheduler()
+        self._awakener = MQTTPublisher(site_topic(self.WAKEUP_CHANNEL, site))
+        self._pauser = MQTTPublisher(site_topic(self.PAUSE_CHANNEL, site))
+        self._stopper = MQTTPublisher(site_topic(self.STOP_CHANNEL, site))
+        self.LISTEN_CHANNEL = site_topic(self.LISTEN_CHANNEL, site)
+        self._idle_stop_key = 'idle-stop:' + self.LISTEN_CHANNEL
+        # Presence has to settle for a moment, absence for longer, before the state machine reacts
+        self._presence = Debouncer('presence:' + self.LISTEN_CHANNEL, self.react,
+                                   {'ON': self.ON_HOLD, 'OFF': self.OFF_HOLD})
         log("ProactiveManagementParallelService: Created")
 
     def run(self):
@@ -47,15 +59,17 @@ class ProactiveManagementParallelService(Thread):
 
     def interact(self, message):
         log("ProactiveManagementParallelService: Got message " + message)
-        if message == "ON":
+        self._presence.push("ON" if message == "ON" else "OFF")
+
+    def react(self, state):
+        log("ProactiveManagementParallelService: Presence is now " + state)
+        if state == "ON":
+            if self._scheduler.cancel(self._idle_stop_key):
+                log("ProactiveManagementParallelService: Cancelled idle stop")
             if self._kodi.is_playing():
                 if self._kodi.is_paused():
                     log("ProactiveManagementParallelService: Playing back")
                     self._pauser.publish("PLAY")
-                    if self._timer is not None:
-                        log("ProactiveManagementParallelService: Cancelling timer")
-                        self._timer.cancel()
-                        self._timer = None
                 else:
                     log("ProactiveManagementParallelService: No effects")
             else:
@@ -67,7 +81,8 @@ class ProactiveManagementParallelService(Thread):
             else:
                 log("ProactiveManagementParallelService: Pausing and starting timer")
                 self._pauser.publish("PAUSE")
-                self._timer = Timer(self.TIMER_DEADLINE, self.stop)
+                self._scheduler.schedule_in(self._idle_stop_key, self.TIMER_DEADLINE, self.stop)
 
-    def stop(self):
+    def stop(self, keys: list = None):
+        log("ProactiveManagementParallelService: Nobody came back, stopping")
         self._stopper.publish("STOP HAMMERTIME")
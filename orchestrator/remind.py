@@ -1,10 +1,14 @@
-from json import loads as dejson
+from datetime import datetime
+from json import dumps as dictstr, loads as dejson
 from logging import debug as log, warning as logw
-from threading import Thread, Timer
-from time import sleep
+from threading import Thread
+from time import time
 
-from lib.communicator import MQTTDaemon, MQTTPublisher
-from lib.reminders import ReminderData
+from lib.communicator import MQTTConnection, MQTTDaemon, MQTTPublisher
+from lib.metrics import Metrics
+from lib.reminders import ReminderData, next_fire_offsets
+from lib.scheduler import TimerScheduler
+from lib.sites import Site, site_topic
 
 import traceback
 
@@ -32,12 +36,19 @@ import traceback
 class ReminderIDSenderParallelService(Thread):
     LISTEN_CHANNEL = "/dsh/damaso/reminders/requests"
     ANSWER_CHANNEL = "/dsh/damaso/reminders/IDresponses"
+    SNAPSHOT_CHANNEL = "/dsh/damaso/reminders/snapshot"
 
-    def __init__(self):
+    def __init__(self, site: Site = None):
         Thread.__init__(self)
-        self._reminders = ReminderData()
-        self._reminders.load()
-        self._publisher = MQTTPublisher(self.ANSWER_CHANNEL)
+        self._reminders = ReminderData() if site is None else site.reminders
+        self._publisher = MQTTPublisher(site_topic(self.ANSWER_CHANNEL, site))
+        self._snapshot_publisher = MQTTPublisher(site_topic(self.SNAPSHOT_CHANNEL, site), retain=True)
+        self.LISTEN_CHANNEL = site_topic(self.LISTEN_CHANNEL, site)
+        self._published_version = None
+        self._add_id = self._reminders.register_add_callback(self.publish_snapshot)
+        self._remove_id = self._reminders.register_remove_callback(self.publish_snapshot)
+        # The first snapshot goes out once the runtime is connected, publishing while it is built would start it
+        MQTTConnection().register_connect_callback(lambda client: self.publish_snapshot())
         log("ReminderIDSenderParallelService: Created")
 
     def run(self):
@@ -53,49 +64,121 @@ class ReminderIDSenderParallelService(Thread):
             traceback.print_exc()
             pass
 
+    def publish_snapshot(self, r_id: str = None):
+        version = self._reminders.get_version()
+        if version != self._published_version:
+            log("ReminderIDSenderParallelService: Publishing snapshot version " + str(version))
+            self._published_version = version
+            self._snapshot_publisher.publish(self._reminders.jsonify_id())
+
     
 class ReminderTimersService:
     ANSWER_CHANNEL = "/dsh/damaso/reminders/notifications"
-
-    def __init__(self):
-        self._timers = {}
-        self._publisher = MQTTPublisher(self.ANSWER_CHANNEL)
-        self._reminders = ReminderData()
+    CATCH_UP_POLICIES = ('all', 'latest', 'skip')
+    CATCH_UP = 'latest'
+    HEARTBEAT_INTERVAL = 60.0
+    # Legacy devices expect one message per reminder carrying only its concept
+    LEGACY_NOTIFICATIONS = False
+
+    def __init__(self, site: Site = None):
+        # Every site shares the same scheduler, reminder ids are unique across sites
+        self._scheduler = TimerScheduler()
+        self._publisher = MQTTPublisher(site_topic(self.ANSWER_CHANNEL, site))
+        self._reminders = ReminderData() if site is None else site.reminders
+        self._heartbeat_key = 'heartbeat:' + self._publisher.topic
         self._add_id = self._reminders.register_add_callback(self._start_timer)
         self._remove_id = self._reminders.register_remove_callback(self._stop_timer)
+        Metrics().register_gauge('active_timers', lambda: len(self._scheduler))
+        self.rearm()
         log("ReminderTimersService: Created and started")
 
+    def rearm(self):
+        now = time()
+        boot = datetime.fromtimestamp(now)
+        last_seen = self._reminders.get_heartbeat()
+        # One-shot reminders only fire in the run that created them, as before
+        fires = [(ms, reminder) for ms, reminder in self._reminders.get_next_fires(boot)
+                 if self._reminders.is_repeating(reminder)]
+        log("ReminderTimersService: Re-arming " + str(len(fires)) + " reminders")
+        self._scheduler.schedule_many([(reminder.id, now - now % 60 + ms / 1000) for ms, reminder in fires],
+                                      self.notify_all)
+        if last_seen is not None:
+            self.catch_up(last_seen, boot)
+        self._beat([])
+
+    def catch_up(self, last_seen: datetime, now: datetime):
+        missed = [(ms, reminder) for ms, reminder in self._reminders.get_missed_fires(last_seen, now)
+                  if self._reminders.is_repeating(reminder)]
+        if len(missed) == 0:
+            return
+        logw("ReminderTimersService: " + str(len(missed)) + " reminders were missed since " + str(last_seen)
+             + ", catching up with policy " + self.CATCH_UP)
+        Metrics().increment('reminders_missed_total', value=len(missed))
+        if self.CATCH_UP == 'latest':
+            latest = missed[0][0]
+            missed = [(ms, reminder) for ms, reminder in missed if ms == latest]
+        elif self.CATCH_UP == 'skip':
+            missed = []
+        self._publish([reminder for _, reminder in reversed(missed)])
+
+    def _beat(self, keys: list):
+        self._reminders.heartbeat()
+        self._scheduler.schedule_in(self._heartbeat_key, self.HEARTBEAT_INTERVAL, self._beat)
+
     def _start_timer(self, r_id: str):
         log("ReminderTimersService: Starting timer for " + r_id)
-        secs = self._reminders.get_seconds_to(r_id)
-        tmr = Timer(secs, self.notify, [r_id])
-        self._timers[r_id] = tmr
-        self._timers[r_id].start()
+        reminder = self._reminders.get_reminder(r_id)
+        if reminder is None:
+            return
+        # The offset and its base come from the same instant, so a minute boundary in between can't skew them
+        now = time()
+        ms = next_fire_offsets([reminder.minute_of_week], datetime.fromtimestamp(now))[0]
+        # Reminder offsets are whole minutes from the current one, so align them to share deadlines
+        self._scheduler.schedule(r_id, now - now % 60 + ms / 1000, self.notify_all)
 
     def _stop_timer(self, r_id):
         log("ReminderTimersService: Stopping timer for " + r_id)
-        try:
-            self._timers.pop(r_id).stop()
-        except Exception:
+        if not self._scheduler.cancel(r_id):
             logw("ReminderTimersService: Error stopping timer. Probably " + r_id + " does not exist")
 
     def notify(self, r_id: str):
-        log("ReminderTimersService: Notifying reminder " + r_id)
-        rmndr = self._reminders.get_reminder(r_id)
-        if rmndr is not None:
-            self._publisher.publish(rmndr[2])
-        sleep(1.0)  # Wait for a second to make sure enough time has passed
-        self._reminders.repeat_reminder(r_id)
+        self.notify_all([r_id])
+
+    def _publish(self, reminders: list):
+        if len(reminders) == 0:
+            return
+        if self.LEGACY_NOTIFICATIONS:
+            for reminder in reminders:
+                self._publisher.publish(reminder.concept)
+        else:
+            self._publisher.publish(dictstr({'recordatorios': [{'sonido': reminder.concept, 'id': reminder.id}
+                                                               for reminder in reminders]}))
+        Metrics().increment('reminders_notified_total', value=len(reminders))
+
+    def notify_all(self, r_ids: list):
+        log("ReminderTimersService: Notifying " + str(len(r_ids)) + " reminders")
+        now = time()
+        # Deadlines are whole minutes, so this is the minute the reminders were due in even if the timer ran late
+        fired = now - now % 60
+        reminders = [reminder for reminder in map(self._reminders.get_reminder, r_ids) if reminder is not None]
+        self._publish(reminders)
+        self._reminders.heartbeat(now)
+        # The next firing is counted from the fire minute, so it is always a week away for the ones just notified
+        repeating = [reminder for reminder in reminders if self._reminders.is_repeating(reminder)]
+        offsets = next_fire_offsets([reminder.minute_of_week for reminder in repeating], datetime.fromtimestamp(fired))
+        self._scheduler.schedule_many([(reminder.id, fired + ms / 1000) for ms, reminder in zip(offsets, repeating)],
+                                      self.notify_all)
 
 
 class ReminderManagementParallelService(Thread):
     LISTEN_CHANNEL = "/dsh/damaso/reminders/management"
     ANSWER_CHANNEL = "/dsh/damaso/reminders/management/ids"
 
-    def __init__(self):
+    def __init__(self, site: Site = None):
         Thread.__init__(self)
-        self._reminders = ReminderData()
-        self._publisher = MQTTPublisher(self.ANSWER_CHANNEL)
+        self._reminders = ReminderData() if site is None else site.reminders
+        self._publisher = MQTTPublisher(site_topic(self.ANSWER_CHANNEL, site))
+        self.LISTEN_CHANNEL = site_topic(self.LISTEN_CHANNEL, site)
         log("ReminderManagementParallelService: Created")
 
     def run(self) -> None:
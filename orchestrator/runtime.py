@@ -0,0 +1,145 @@
+import asyncio
+from logging import debug as log
+from threading import Event, Semaphore, Thread
+
+from lib.aio import AsyncMQTTDriver
+from lib.communicator import MQTTConnection, MQTTDaemon, MQTTRouter
+from lib.kodiCtrl import KodiRpc
+from lib.sites import site_pattern
+from lib.startup import StartupReport
+from lib.workers import OrderedWorkerPool
+from orchestrator.proactivity import ProactiveAwakenParallelService, ProactiveManagementParallelService
+from orchestrator.remind import ReminderIDSenderParallelService, ReminderManagementParallelService, \
+    ReminderTimersService
+from orchestrator.stats import StatsPublisherService
+from orchestrator.tv import TVBroadcastRemindersParallelService, TVChannelParellelService, \
+    TVGuideParallelService, TVPauseParallelService, TVStopParallelService
+
+# Services grouped by subsystem, the supervisor runs each subsystem in a process of its own
+SUBSYSTEMS = {'reminders': (ReminderIDSenderParallelService, ReminderTimersService,
+                            ReminderManagementParallelService),
+              'tv': (TVPauseParallelService, TVStopParallelService, TVChannelParellelService,
+                     TVBroadcastRemindersParallelService, TVGuideParallelService),
+              'proactive': (ProactiveAwakenParallelService, ProactiveManagementParallelService)}
+
+
+def configure_endpoints(broker: str = None, kodi_url: str = None, kodi_events_port: int = None,
+                        epg_cache: str = None):
+    if broker is not None:
+        host, _, port = broker.partition(':')
+        log("Runtime: Using MQTT broker " + broker)
+        MQTTConnection.__wrapped__.HOST = host
+        if len(port) > 0:
+            MQTTConnection.__wrapped__.PORT = int(port)
+    if kodi_url is not None:
+        log("Runtime: Using Kodi at " + kodi_url)
+        KodiRpc.__wrapped__.URL = kodi_url
+    if kodi_events_port is not None:
+        KodiRpc.__wrapped__.EVENTS_PORT = kodi_events_port
+    if epg_cache is not None:
+        KodiRpc.__wrapped__.EPG_CACHE_FILE = epg_cache
+
+
+def use_asyncio():
+    # Before anything publishes, a publish would otherwise start paho's network thread next to the event loop
+    log("Runtime: Leaving the MQTT connection to the asyncio event loop")
+    MQTTConnection.__wrapped__.THREADED = False
+
+
+def build_services(sites: list = None, subsystems: tuple = tuple(SUBSYSTEMS)) -> list:
+    log("Runtime: Building services for " + ", ".join(subsystems))
+    services = []
+    # Without sites the services use the process-wide singletons and the /dsh/damaso topics
+    for site in sites or [None]:
+        for subsystem in subsystems:
+            services.extend(service(site) for service in SUBSYSTEMS[subsystem])
+    services.append(StatsPublisherService())
+    return services
+
+
+def start_workers(workers: int, queue_size: int, policy: str):
+    if workers > 0:
+        pool = OrderedWorkerPool(workers, queue_size, policy)
+        MQTTRouter().set_dispatcher(pool.submit)
+        MQTTDaemon.DISPATCHER = pool.submit
+
+
+def connect_early(startup: StartupReport):
+    # The broker handshake overlaps with loading state, subscriptions go out as soon as they are routed
+    startup.announce_on_exit()
+    MQTTConnection().start()
+
+
+def warm_up(sites: list = None, subsystems: tuple = tuple(SUBSYSTEMS)):
+    # Only the TV services need the EPG, the proactive ones just follow the player
+    if 'tv' not in subsystems and 'proactive' not in subsystems:
+        return
+    log("Runtime: Warming up Kodi")
+    for kodi in [KodiRpc()] if sites is None else [site.kodi for site in sites]:
+        kodi.start_events()
+        if 'tv' in subsystems:
+            kodi.start_refresher()
+
+
+def _when_ready(wait, mode: str, sites: list, startup: StartupReport, subsystems: tuple):
+
+    def announce():
+        with startup.phase('subscribe'):
+            wait()
+        startup.publish_ready(mode)
+        warm_up(sites, subsystems)
+
+    Thread(target=announce, name="StartupAnnouncer", daemon=True).start()
+
+
+def start_threads(services: list, sites: list = None, startup: StartupReport = None,
+                  subsystems: tuple = tuple(SUBSYSTEMS)):
+    log("Runtime: Starting one MQTT client thread per service")
+    listeners = [service for service in services if isinstance(service, Thread)]
+    subscribed = Semaphore(0)
+    MQTTDaemon.SUBSCRIBED_CALLBACK = lambda topic: subscribed.release()
+    for service in listeners:
+        service.start()
+    _when_ready(lambda: [subscribed.acquire() for _ in listeners], 'threads', sites, startup or StartupReport(),
+                subsystems)
+
+
+def run_threads(services: list, sites: list = None, startup: StartupReport = None,
+                subsystems: tuple = tuple(SUBSYSTEMS)):
+    start_threads(services, sites, startup, subsystems)
+    # Kodi's EPG crawl uses thread pools, which refuse work once the main thread has exited
+    Event().wait()
+
+
+def _route(services: list, multisite: bool, coroutines: bool):
+    router = MQTTRouter()
+    for service in services:
+        if hasattr(service, 'LISTEN_CHANNEL'):
+            action = getattr(service, 'ainteract', service.interact) if coroutines else service.interact
+            # Sites share one wildcard subscription per channel instead of one subscription each
+            subscription = site_pattern(service.LISTEN_CHANNEL) if multisite else None
+            router.register(service.LISTEN_CHANNEL, action, subscription=subscription)
+    return router
+
+
+def start_router(services: list, sites: list = None, startup: StartupReport = None,
+                 subsystems: tuple = tuple(SUBSYSTEMS)):
+    log("Runtime: Routing every service through a single MQTT connection")
+    router = _route(services, sites is not None, False)
+    router.start()
+    _when_ready(router.wait_subscribed, 'router', sites, startup or StartupReport(), subsystems)
+
+
+def run_router(services: list, sites: list = None, startup: StartupReport = None,
+               subsystems: tuple = tuple(SUBSYSTEMS)):
+    start_router(services, sites, startup, subsystems)
+    Event().wait()
+
+
+def run_asyncio(services: list, sites: list = None, startup: StartupReport = None,
+                subsystems: tuple = tuple(SUBSYSTEMS)):
+    log("Runtime: Serving every service from an asyncio event loop")
+    use_asyncio()
+    router = _route(services, sites is not None, True)
+    _when_ready(router.wait_subscribed, 'asyncio', sites, startup or StartupReport(), subsystems)
+    asyncio.run(AsyncMQTTDriver().run())
@@ -0,0 +1,24 @@
+from json import dumps
+from logging import debug as log
+
+from lib.communicator import MQTTPublisher
+from lib.metrics import Metrics
+from lib.scheduler import TimerScheduler
+
+
+class StatsPublisherService:
+    ANSWER_CHANNEL = "/dsh/damaso/stats"
+    PUBLISH_INTERVAL = 60.0
+
+    def __init__(self):
+        self._metrics = Metrics()
+        self._scheduler = TimerScheduler()
+        self._publisher = MQTTPublisher(self.ANSWER_CHANNEL)
+        if self.PUBLISH_INTERVAL > 0:
+            self._scheduler.schedule_in(self.ANSWER_CHANNEL, self.PUBLISH_INTERVAL, self.publish)
+        log("StatsPublisherService: Created")
+
+    def publish(self, keys: list = None):
+        log("StatsPublisherService: Publishing stats")
+        self._publisher.publish(dumps(self._metrics.snapshot()))
+        self._scheduler.schedule_in(self.ANSWER_CHANNEL, self.PUBLISH_INTERVAL, self.publish)
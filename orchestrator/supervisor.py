@@ -0,0 +1,104 @@
+import os
+import signal
+import subprocess
+from logging import critical as logc, debug as log, warning as logw
+from time import monotonic, sleep
+
+
+def parse_affinity(entries: list) -> dict:
+    # ["reminders=0", "tv=2,3"] -> {'reminders': {0}, 'tv': {2, 3}}
+    affinity = {}
+    for entry in entries or []:
+        subsystem, _, cpus = entry.partition('=')
+        if len(cpus) == 0:
+            raise ValueError("Expected SUBSYSTEM=CPUS, got " + repr(entry))
+        affinity[subsystem] = {int(cpu) for cpu in cpus.split(',')}
+    return affinity
+
+
+def exit_on_thread_death(hook):
+    # A dead thread would leave the worker half working, exiting lets the supervisor restart it
+    logc("Supervisor: Worker thread " + str(hook.thread.name if hook.thread else None) + " died",
+         exc_info=(hook.exc_type, hook.exc_value, hook.exc_traceback))
+    os._exit(1)
+
+
+class Supervisor:
+    POLL_INTERVAL: float = 0.5
+    RESTART_MIN_DELAY: float = 1.0
+    RESTART_MAX_DELAY: float = 60.0
+    # A worker that stayed up this long is healthy again, its next restart is not delayed
+    STABLE_AFTER: float = 60.0
+    STOP_TIMEOUT: float = 10.0
+
+    def __init__(self, command: list, subsystems: list, affinity: dict = None):
+        # Every worker runs command with --SUBSYSTEM <name> appended
+        self._command = command
+        self._subsystems = subsystems
+        self._affinity = affinity or {}
+        self._processes = {}
+        self._started = {}
+        self._delays = {}
+        self._restarts = {}
+        self._stopping = False
+        log("Supervisor: Created for " + ", ".join(subsystems))
+
+    def _spawn(self, subsystem: str):
+        cpus = self._affinity.get(subsystem)
+        # Set in the child before it starts, so every thread it creates inherits the CPU set
+        pin = (lambda: os.sched_setaffinity(0, cpus)) if cpus is not None else None
+        process = subprocess.Popen(self._command + ['--SUBSYSTEM', subsystem], preexec_fn=pin)
+        log("Supervisor: Started " + subsystem + " worker with pid " + str(process.pid)
+            + ("" if cpus is None else " on CPUs " + str(sorted(cpus))))
+        self._processes[subsystem] = process
+        self._started[subsystem] = monotonic()
+
+    def stop(self, *args):
+        self._stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        for subsystem in self._subsystems:
+            self._spawn(subsystem)
+        try:
+            while not self._stopping:
+                self._check()
+                sleep(self.POLL_INTERVAL)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._terminate()
+
+    def _check(self):
+        now = monotonic()
+        for subsystem in self._subsystems:
+            if subsystem in self._restarts:
+                if now >= self._restarts[subsystem]:
+                    del self._restarts[subsystem]
+                    self._spawn(subsystem)
+                continue
+            code = self._processes[subsystem].poll()
+            if code is None:
+                continue
+            if now - self._started[subsystem] >= self.STABLE_AFTER:
+                delay = self.RESTART_MIN_DELAY
+            else:
+                delay = min(self._delays.get(subsystem, self.RESTART_MIN_DELAY / 2) * 2, self.RESTART_MAX_DELAY)
+            self._delays[subsystem] = delay
+            logw("Supervisor: " + subsystem + " worker exited with code " + str(code) + ", restarting in "
+                 + str(delay) + "s")
+            self._restarts[subsystem] = now + delay
+
+    def _terminate(self):
+        log("Supervisor: Stopping workers")
+        for process in self._processes.values():
+            if process.poll() is None:
+                process.terminate()
+        deadline = monotonic() + self.STOP_TIMEOUT
+        for subsystem, process in self._processes.items():
+            try:
+                process.wait(max(deadline - monotonic(), 0.0))
+            except subprocess.TimeoutExpired:
+                logw("Supervisor: " + subsystem + " worker did not stop, killing it")
+                process.kill()
+                process.wait()
@@ -1,17 +1,25 @@
+import asyncio
+from datetime import datetime
+from json import dumps as dictstr, loads as dejson
 from logging import debug as log, warning as logw
 from threading import Thread
 
-from lib.communicator import MQTTDaemon
+from lib.aio import AsyncKodiRpc
+from lib.communicator import MQTTDaemon, MQTTPublisher
 from lib.kodiCtrl import KodiRpc
 from lib.reminders import ReminderData
+from lib.sites import Site, site_topic
+from orchestrator.remind import ReminderManagementParallelService
 
 
 class TVPauseParallelService(Thread):
     LISTEN_CHANNEL = "/dsh/damaso/playing"
 
-    def __init__(self):
+    def __init__(self, site: Site = None):
         Thread.__init__(self)
-        self._kodi = KodiRpc()
+        self._kodi = KodiRpc() if site is None else site.kodi
+        self._async_kodi = AsyncKodiRpc() if site is None else site.async_kodi
+        self.LISTEN_CHANNEL = site_topic(self.LISTEN_CHANNEL, site)
         log("TVPauseParallelService: Created")
 
     def run(self):
@@ -22,13 +30,19 @@ class TVPauseParallelService(Thread):
         log("TVPauseParallelService: Got message " + message)
         self._kodi.play_pause()
 
+    async def ainteract(self, message):
+        log("TVPauseParallelService: Got message " + message)
+        await self._async_kodi.play_pause()
+
 
 class TVStopParallelService(Thread):
     LISTEN_CHANNEL = "/dsh/damaso/stop"
 
-    def __init__(self):
+    def __init__(self, site: Site = None):
         Thread.__init__(self)
-        self._kodi = KodiRpc()
+        self._kodi = KodiRpc() if site is None else site.kodi
+        self._async_kodi = AsyncKodiRpc() if site is None else site.async_kodi
+        self.LISTEN_CHANNEL = site_topic(self.LISTEN_CHANNEL, site)
         log("TVStopParallelService: Created")
 
     def run(self):
@@ -39,13 +53,19 @@ class TVStopParallelService(Thread):
         log("TVStopParallelService: Got message " + message)
         self._kodi.stop()
 
+    async def ainteract(self, message):
+        log("TVStopParallelService: Got message " + message)
+        await self._async_kodi.stop()
+
 
 class TVChannelParellelService(Thread):
     LISTEN_CHANNEL = "/dsh/damaso/channel"
 
-    def __init__(self):
+    def __init__(self, site: Site = None):
         Thread.__init__(self)
-        self._kodi = KodiRpc()
+        self._kodi = KodiRpc() if site is None else site.kodi
+        self._async_kodi = AsyncKodiRpc() if site is None else site.async_kodi
+        self.LISTEN_CHANNEL = site_topic(self.LISTEN_CHANNEL, site)
         log("TVChannelParallelService: Created")
 
     def run(self):
@@ -56,15 +76,28 @@ class TVChannelParellelService(Thread):
         log("TVChannelParallelService: Got message " + message)
         self._kodi.play_channel(message)
 
+    async def ainteract(self, message):
+        log("TVChannelParallelService: Got message " + message)
+        await self._async_kodi.play_channel(message)
+
 
 class TVBroadcastRemindersParallelService(Thread):
     LISTEN_CHANNEL = "/dsh/damaso/reminders/broadcast"
+    REMINDERS_CHANNEL = ReminderManagementParallelService.LISTEN_CHANNEL
     TV_CONCEPT = 9
+    # Set when the reminders live in another process, new reminders are then sent to it through the broker
+    VIA_BROKER = False
 
-    def __init__(self):
+    def __init__(self, site: Site = None):
         Thread.__init__(self)
-        self._kodi = KodiRpc()
-        self._reminders = ReminderData()
+        self._kodi = KodiRpc() if site is None else site.kodi
+        self._async_kodi = AsyncKodiRpc() if site is None else site.async_kodi
+        if self.VIA_BROKER:
+            self._reminders = None
+            self._adder = MQTTPublisher(site_topic(self.REMINDERS_CHANNEL, site))
+        else:
+            self._reminders = ReminderData() if site is None else site.reminders
+        self.LISTEN_CHANNEL = site_topic(self.LISTEN_CHANNEL, site)
         log("TVBroadcastRemindersParallelService: Created")
 
     def run(self) -> None:
@@ -73,8 +106,99 @@ class TVBroadcastRemindersParallelService(Thread):
 
     def interact(self, message):
         log("TVBroadcastRemindersParallelService: Got message " + message)
-        broadcast = self._kodi.get_next_time(message)
-        if broadcast is not None:
+        self._remind(message, self._kodi.get_next_time(message))
+
+    async def ainteract(self, message):
+        log("TVBroadcastRemindersParallelService: Got message " + message)
+        broadcast = await self._async_kodi.get_next_time(message)
+        # Adding a reminder syncs the journal to disk, which must not stall the event loop
+        await asyncio.get_running_loop().run_in_executor(None, self._remind, message, broadcast)
+
+    def _remind(self, message, broadcast):
+        if broadcast is None:
+            logw("TVBroadcastRemindersParallelService: " + message + " not found")
+        elif self._reminders is None:
+            self._adder.publish(dictstr({'action': 'ADD', 'hour': broadcast.hour, 'minute': broadcast.minute,
+                                         'weekday': broadcast.isoweekday(), 'concept': self.TV_CONCEPT}))
+        else:
             self._reminders.add_reminder(broadcast.hour, broadcast.minute, broadcast.isoweekday(), self.TV_CONCEPT)
+
+
+# Requests: {"query": "now", "channel": "La 1"}, {"query": "between", "from": "2026-10-18 21:00:00",
+# "to": "2026-10-18 23:00:00", "channel": optional} or {"query": "titles", "prefix": "NOTI"}, with optional
+# "limit", "cursor" (from the previous page) and "id" (echoed back in the answer)
+class TVGuideParallelService(Thread):
+    LISTEN_CHANNEL = "/dsh/damaso/tv/guide"
+    ANSWER_CHANNEL = "/dsh/damaso/tv/guide/responses"
+    PAGE_SIZE = 10
+    MAX_PAGE_SIZE = 50
+
+    def __init__(self, site: Site = None):
+        Thread.__init__(self)
+        self._kodi = KodiRpc() if site is None else site.kodi
+        self._publisher = MQTTPublisher(site_topic(self.ANSWER_CHANNEL, site))
+        self.LISTEN_CHANNEL = site_topic(self.LISTEN_CHANNEL, site)
+        log("TVGuideParallelService: Created")
+
+    def run(self):
+        log("TVGuideParallelService: Running")
+        MQTTDaemon(self.interact, self.LISTEN_CHANNEL)
+
+    def interact(self, message):
+        log("TVGuideParallelService: Got message " + message)
+        request = {}
+        try:
+            request = dejson(message)
+            answer = self._answer(request)
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            logw("TVGuideParallelService: Could not answer " + message + ": " + str(error))
+            answer = {'error': str(error)}
+        if isinstance(request, dict) and 'id' in request:
+            answer['id'] = request['id']
+        self._publisher.publish(dictstr(answer))
+
+    async def ainteract(self, message):
+        if self._kodi._snapshot is None:
+            # Only a cold start waits for Kodi, answers are served from memory afterwards
+            await asyncio.get_running_loop().run_in_executor(None, self._kodi.get_guide)
+        self.interact(message)
+
+    @staticmethod
+    def _cursor(guide, position: int) -> str:
+        # Positions only mean something in the EPG they come from
+        return None if position is None else str(int(guide.created)) + '-' + str(position)
+
+    @staticmethod
+    def _position(guide, cursor: str) -> int:
+        if cursor is None:
+            return 0
+        created, _, position = cursor.partition('-')
+        if int(created) != int(guide.created):
+            raise ValueError("The EPG was refreshed, start again without a cursor")
+        return int(position)
+
+    def _answer(self, request: dict) -> dict:
+        guide = self._kodi.get_guide()
+        limit = int(request.get('limit', self.PAGE_SIZE))
+        if limit < 1 or limit > self.MAX_PAGE_SIZE:
+            raise ValueError("limit must be between 1 and " + str(self.MAX_PAGE_SIZE))
+        position = self._position(guide, request.get('cursor'))
+        query = request['query']
+        if query == 'titles':
+            titles, following = guide.titles(request['prefix'], datetime.now(), position, limit)
+            return {'titulos': titles, 'siguiente': self._cursor(guide, following)}
+        if query == 'now':
+            start, end = datetime.now(), None
+            channel_name = request['channel']
+        elif query == 'between':
+            start, end = datetime.fromisoformat(request['from']), datetime.fromisoformat(request['to'])
+            channel_name = request.get('channel')
         else:
-            logw("TVBroadcastRemindersParallelService: " + message + " not found")
+            raise ValueError("Unknown query " + str(query))
+        channel_id = None
+        if channel_name is not None:
+            channel_id = guide.channels.lookup(channel_name)
+            if channel_id is None:
+                raise ValueError("Channel " + channel_name + " not found")
+        broadcasts, following = guide.airing(start, end, channel_id, position, limit)
+        return {'emisiones': broadcasts, 'siguiente': self._cursor(guide, following)}
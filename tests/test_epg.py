@@ -0,0 +1,143 @@
+import os
+import random
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from lib.epg import EpgSnapshot
+
+KODI_TIME = '%Y-%m-%d %H:%M:%S'
+BASE = datetime(2026, 10, 18)
+TITLES = ['Noticias', 'Noche de cine', 'Nada que perder', 'Deportes', 'El tiempo', 'Ópera prima', 'Zoo']
+
+
+def random_guide(seed: int) -> tuple:
+    rng = random.Random(seed)
+    channels = [{'label': 'Canal ' + str(i), 'channelid': 10 + i} for i in range(12)]
+    broadcasts = []
+    for channel in channels:
+        moment = BASE
+        while moment < BASE + timedelta(days=2):
+            length = timedelta(minutes=rng.choice([5, 30, 60, 90, 240]))
+            broadcasts.append({'label': rng.choice(TITLES) + ' ' + str(rng.randrange(5)),
+                               'starttime': moment.strftime(KODI_TIME),
+                               'endtime': (moment + length).strftime(KODI_TIME),
+                               'channelid': channel['channelid']})
+            moment += length
+    # Broadcasts overlapping the rest of their channel's listing, one of a channel missing from the list
+    # and one without an end
+    broadcasts.append({'label': 'Maratón', 'starttime': BASE.strftime(KODI_TIME),
+                       'endtime': (BASE + timedelta(hours=20)).strftime(KODI_TIME), 'channelid': 12})
+    broadcasts.append({'label': 'Carta de ajuste', 'starttime': (BASE + timedelta(hours=3)).strftime(KODI_TIME),
+                       'endtime': (BASE + timedelta(hours=27)).strftime(KODI_TIME), 'channelid': 15})
+    broadcasts.append({'label': 'Huérfano', 'starttime': BASE.strftime(KODI_TIME),
+                       'endtime': (BASE + timedelta(hours=24)).strftime(KODI_TIME), 'channelid': 999})
+    broadcasts.append({'label': 'Sin fin', 'starttime': (BASE + timedelta(hours=5)).strftime(KODI_TIME),
+                       'channelid': 11})
+    return channels, broadcasts
+
+
+def entry(broadcast: dict) -> tuple:
+    return (broadcast['starttime'], broadcast['channelid'], broadcast['label'].strip(),
+            broadcast.get('endtime') or broadcast['starttime'])
+
+
+class EpgSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.channels, self.broadcasts = random_guide(7)
+        self.snapshot = EpgSnapshot.build(self.channels, self.broadcasts)
+        self.rng = random.Random(11)
+
+    def linear_airing(self, start: datetime, end: datetime, channel_id: int) -> list:
+        since = start.strftime(KODI_TIME)
+        until = end.strftime(KODI_TIME) if end is not None else None
+        return sorted(entry(br) for br in self.broadcasts
+                      if (channel_id is None or br['channelid'] == channel_id)
+                      and (until is None or br['starttime'] < until)
+                      and (entry(br)[3] > since or br['starttime'] >= since))
+
+    def linear_titles(self, prefix: str, now: datetime) -> list:
+        raw = EpgSnapshot.normalize_title(prefix).encode('utf-8')
+        labels, starts = {}, {}
+        for br in self.broadcasts:
+            key = EpgSnapshot.normalize_title(br['label']).encode('utf-8')
+            labels.setdefault(key, br['label'].strip())
+            starts.setdefault(key, None)
+            if br['starttime'] >= now.strftime(KODI_TIME) and (starts[key] is None or br['starttime'] < starts[key]):
+                starts[key] = br['starttime']
+        return [{'label': labels[key], 'starttime': starts[key]} for key in sorted(labels) if key.startswith(raw)]
+
+    def pages(self, query, limit: int) -> list:
+        found, cursor = [], 0
+        # A cursor that stops advancing would page forever
+        for _ in range(len(self.broadcasts) + 2):
+            page, cursor = query(cursor, limit)
+            self.assertLessEqual(len(page), limit)
+            found += page
+            if cursor is None:
+                return found
+        self.fail("Paging did not end")
+
+    def assert_airing(self, snapshot: EpgSnapshot, start: datetime, end: datetime, channel_id: int, limit: int):
+        found = self.pages(lambda cursor, size: snapshot.airing(start, end, channel_id, cursor, size), limit)
+        order = [(br['starttime'], br['channelid']) for br in found]
+        self.assertEqual(order, sorted(order))
+        self.assertEqual(sorted(entry(br) for br in found), self.linear_airing(start, end, channel_id))
+
+    def test_airing_matches_linear_scan(self):
+        for _ in range(300):
+            start = BASE + timedelta(minutes=self.rng.randrange(-120, 60 * 50))
+            end = start + timedelta(minutes=self.rng.randrange(0, 300)) if self.rng.random() < 0.8 else None
+            channel_id = self.rng.choice([None, 10, 12, 15, 21])
+            if channel_id is None and end is None:
+                continue
+            self.assert_airing(self.snapshot, start, end, channel_id, self.rng.choice([1, 3, 10, 50]))
+
+    def test_airing_includes_long_overlapping_broadcasts(self):
+        moment = BASE + timedelta(hours=19)
+        found, _ = self.snapshot.airing(moment, moment + timedelta(minutes=1), 12, 0, 50)
+        self.assertIn('Maratón', [br['label'] for br in found])
+        found = self.pages(lambda cursor, size: self.snapshot.airing(moment, moment + timedelta(minutes=1), None,
+                                                                     cursor, size), 2)
+        self.assertTrue({'Maratón', 'Carta de ajuste', 'Huérfano'} <= {br['label'] for br in found})
+
+    def test_airing_on_unknown_channel_is_empty(self):
+        self.assertEqual(self.snapshot.airing(BASE, BASE + timedelta(days=1), 999), ([], None))
+
+    def test_titles_match_linear_scan(self):
+        for prefix in ['', 'n', 'NO', 'noche', ' Nada ', 'ópera', 'zz', 'Huér']:
+            for now in [BASE - timedelta(hours=1), BASE + timedelta(hours=30), BASE + timedelta(days=5)]:
+                for limit in [1, 4, 50]:
+                    found = self.pages(lambda cursor, size: self.snapshot.titles(prefix, now, cursor, size), limit)
+                    self.assertEqual(found, self.linear_titles(prefix, now))
+
+    def test_next_start(self):
+        now = BASE + timedelta(hours=30)
+        for title in self.linear_titles('', now):
+            start = self.snapshot.next_start(title['label'].lower(), now)
+            self.assertEqual(start.strftime(KODI_TIME) if start is not None else None, title['starttime'])
+        self.assertIsNone(self.snapshot.next_start('No existe', now))
+
+    def test_saved_cache_answers_the_same(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'epg.cache')
+            self.snapshot.save(path)
+            loaded = EpgSnapshot.load(path)
+            self.assertEqual(list(loaded.broadcasts()), list(self.snapshot.broadcasts()))
+            for _ in range(30):
+                start = BASE + timedelta(minutes=self.rng.randrange(0, 60 * 48))
+                self.assert_airing(loaded, start, start + timedelta(hours=2), self.rng.choice([None, 12]), 5)
+            self.assertEqual(loaded.channels.lookup('Canal 3'), 13)
+
+    def test_unreadable_cache_is_ignored(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'epg.cache')
+            self.assertIsNone(EpgSnapshot.load(path))
+            with open(path, 'wb') as cache:
+                cache.write(b'DEPG' + bytes(10))
+            self.assertIsNone(EpgSnapshot.load(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,202 @@
+import os
+import random
+import tempfile
+import unittest
+from datetime import datetime, time, timedelta
+
+from lib.reminders import ReminderData
+from lib.reminderStore import MINUTES_PER_WEEK, MemoryReminderStore, Reminder, SqliteReminderStore
+
+
+def random_reminders(rng: random.Random, count: int) -> list:
+    return [Reminder(time(rng.randrange(24), rng.randrange(60)), rng.randrange(1, 8), rng.randrange(1, 10),
+                     'r' + str(i).zfill(4)) for i in range(count)]
+
+
+def by_minute(reminders) -> list:
+    return sorted(reminders, key=lambda reminder: (reminder.minute_of_week, reminder.id))
+
+
+class StoreBehaviour:
+    STORE = None
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.directory = self._directory.name
+        self.rng = random.Random(5)
+        self.reminders = random_reminders(self.rng, 200)
+        # Every reminder of one minute shares it with another one
+        self.reminders += [Reminder(r.time, r.weekday, 3, r.id + 'b') for r in self.reminders[:20]]
+        self.store = self.open()
+        self.store.add(self.reminders[:1])
+        self.store.add(self.reminders[1:])
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def open(self):
+        store = self.STORE(self.directory)
+        store.load()
+        return store
+
+    def test_get_and_all(self):
+        self.assertEqual(len(self.store), len(self.reminders))
+        self.assertEqual(self.store.all(), by_minute(self.reminders))
+        self.assertEqual(self.store.get('r0007'), self.reminders[7])
+        self.assertIsNone(self.store.get('missing'))
+
+    def test_remove(self):
+        self.assertEqual(self.store.remove('r0003'), self.reminders[3])
+        self.assertIsNone(self.store.remove('r0003'))
+        self.assertIsNone(self.store.get('r0003'))
+        self.assertEqual(self.store.all(), by_minute(r for r in self.reminders if r.id != 'r0003'))
+
+    def test_between_matches_linear_scan(self):
+        ordered = by_minute(self.reminders)
+        for _ in range(200):
+            start, end = self.rng.randrange(MINUTES_PER_WEEK + 1), self.rng.randrange(MINUTES_PER_WEEK + 1)
+            if start <= end:
+                expected = [r for r in ordered if start <= r.minute_of_week < end]
+            else:
+                # Wraps around the end of the week
+                expected = ([r for r in ordered if r.minute_of_week >= start]
+                            + [r for r in ordered if r.minute_of_week < end])
+            self.assertEqual(self.store.between(start, end), expected)
+
+    def test_upcoming_matches_linear_scan(self):
+        ordered = by_minute(self.reminders)
+        for _ in range(200):
+            start = self.rng.randrange(MINUTES_PER_WEEK + 1)
+            count = self.rng.choice([0, 1, 5, 50, len(ordered), len(ordered) + 10])
+            later = [r for r in ordered if r.minute_of_week >= start]
+            expected = (later + [r for r in ordered if r.minute_of_week < start])[:count]
+            self.assertEqual(self.store.upcoming(start, count), expected)
+
+    def test_by_concept(self):
+        for concept in range(1, 10):
+            self.assertEqual(self.store.by_concept(concept),
+                             by_minute(r for r in self.reminders if r.concept == concept))
+
+    def test_reload(self):
+        self.store.remove('r0011')
+        self.store.save()
+        self.store.remove('r0012')
+        self.store.add([Reminder(time(8, 30), 2, 4, 'late')])
+        expected = by_minute([r for r in self.reminders if r.id not in ('r0011', 'r0012')]
+                             + [Reminder(time(8, 30), 2, 4, 'late')])
+        self.assertEqual(self.open().all(), expected)
+
+
+class MemoryReminderStoreTest(StoreBehaviour, unittest.TestCase):
+    STORE = MemoryReminderStore
+
+    def test_journal_replay_without_save(self):
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'reminders.sav')))
+        self.assertEqual(self.open().all(), by_minute(self.reminders))
+
+    def test_save_compacts_the_journal(self):
+        self.assertTrue(self.store.save())
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'reminders.journal')))
+        self.assertFalse(self.store.save())
+        self.assertEqual(self.open().all(), by_minute(self.reminders))
+
+    def test_unreadable_journal_entries_are_skipped(self):
+        self.store.save()
+        self.store.remove('r0001')
+        with open(os.path.join(self.directory, 'reminders.journal'), 'a') as journal:
+            journal.write('{"op": "ADD", "id": "cut\n')
+        self.assertEqual(self.open().all(), by_minute(r for r in self.reminders if r.id != 'r0001'))
+
+
+class SqliteReminderStoreTest(StoreBehaviour, unittest.TestCase):
+    STORE = SqliteReminderStore
+
+    def test_migrates_pickle_and_journal(self):
+        directory = os.path.join(self.directory, 'legacy')
+        os.makedirs(directory)
+        legacy = MemoryReminderStore(directory)
+        legacy.load()
+        legacy.add(self.reminders[:50])
+        legacy.save()
+        legacy.add(self.reminders[50:60])
+        legacy.remove('r0004')
+        expected = by_minute(r for r in self.reminders[:60] if r.id != 'r0004')
+        store = SqliteReminderStore(directory)
+        store.load()
+        self.assertEqual(store.all(), expected)
+        self.assertTrue(os.path.exists(os.path.join(directory, 'reminders.sav.migrated')))
+        self.assertFalse(os.path.exists(os.path.join(directory, 'reminders.sav')))
+        self.assertFalse(os.path.exists(os.path.join(directory, 'reminders.journal')))
+        # Migrated once, a second start reads the database only
+        store = SqliteReminderStore(directory)
+        store.load()
+        self.assertEqual(store.all(), expected)
+
+
+class ReminderDataBehaviour:
+    STORE = None
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self._settings = ReminderData.__wrapped__.SITES_DIRECTORY, ReminderData.__wrapped__.STORE
+        ReminderData.__wrapped__.SITES_DIRECTORY = self._directory.name
+        ReminderData.__wrapped__.STORE = self.STORE
+        self.data = ReminderData.__wrapped__('test')
+        self.added = []
+        self.data.register_add_callback(self.added.append)
+
+    def tearDown(self):
+        # Saving arms the next autosave, which would otherwise outlive the directory
+        self.data._timer.cancel()
+        ReminderData.__wrapped__.SITES_DIRECTORY, ReminderData.__wrapped__.STORE = self._settings
+        self._directory.cleanup()
+
+    def test_add_reminders(self):
+        version = self.data.get_version()
+        r_ids = self.data.add_reminders([(9, 0, 1, 2), (25, 0, 1, 2), (21, 30, 5, 9), (9, 0, 1, 7)])
+        self.assertIsNone(r_ids[1])
+        self.assertEqual(self.added, [r_ids[0], r_ids[2], r_ids[3]])
+        self.assertEqual(self.data.get_version(), version + 1)
+        self.assertEqual(self.data.get_reminder(r_ids[2]), Reminder(time(21, 30), 5, 9, r_ids[2]))
+
+    def test_queries(self):
+        monday, friday, sunday = self.data.add_reminders([(9, 0, 1, 2), (21, 30, 5, 9), (23, 59, 7, 9)])
+        self.assertEqual([r.id for r in self.data.get_reminders_by_concept(9)], [friday, sunday])
+        self.assertEqual(self.data.get_reminders_by_concept(4), [])
+        friday_evening = 4 * 24 * 60 + 21 * 60
+        self.assertEqual([r.id for r in self.data.get_reminders_between(friday_evening, 9 * 60 + 1)],
+                         [friday, sunday, monday])
+        self.assertEqual(self.data.get_reminders_between(0, 9 * 60), [])
+
+    def test_next_reminders(self):
+        monday, friday, sunday = self.data.add_reminders([(9, 0, 1, 2), (21, 30, 5, 9), (23, 59, 7, 9)])
+        # 2026-10-16 is a Friday, a reminder due in the current minute is a week away
+        now = datetime(2026, 10, 16, 21, 30, 20)
+        fires = self.data.get_next_reminders(3, now)
+        self.assertEqual([r.id for _, r in fires], [sunday, monday, friday])
+        current_minute = now.replace(second=0)
+        self.assertEqual([current_minute + timedelta(milliseconds=ms) for ms, _ in fires],
+                         [datetime(2026, 10, 18, 23, 59), datetime(2026, 10, 19, 9, 0),
+                          datetime(2026, 10, 23, 21, 30)])
+        self.assertEqual([r.id for _, r in self.data.get_next_reminders(1, now)], [sunday])
+
+    def test_remove_and_reload(self):
+        keep, drop = self.data.add_reminders([(9, 0, 1, 2), (10, 0, 1, 2)])
+        self.assertTrue(self.data.remove_reminder(drop))
+        self.assertFalse(self.data.remove_reminder(drop))
+        self.data.save()
+        reloaded = ReminderData.__wrapped__('test')
+        reloaded._timer.cancel()
+        self.assertEqual([r.id for r in reloaded.get_all_reminders()], [keep])
+
+
+class MemoryReminderDataTest(ReminderDataBehaviour, unittest.TestCase):
+    STORE = 'memory'
+
+
+class SqliteReminderDataTest(ReminderDataBehaviour, unittest.TestCase):
+    STORE = 'sqlite'
+
+
+if __name__ == '__main__':
+    unittest.main()
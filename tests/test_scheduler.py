@@ -0,0 +1,89 @@
+import unittest
+from threading import Condition
+from time import time
+
+from lib.scheduler import TimerScheduler
+
+
+class Recorder:
+
+    def __init__(self):
+        self.batches = []
+        self._condition = Condition()
+
+    def __call__(self, keys: list):
+        with self._condition:
+            self.batches.append(sorted(keys))
+            self._condition.notify_all()
+
+    def wait_for(self, batches: int, timeout: float = 5.0) -> list:
+        with self._condition:
+            self._condition.wait_for(lambda: len(self.batches) >= batches, timeout)
+            return list(self.batches)
+
+
+class TimerSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = TimerScheduler.__wrapped__()
+        self.fired = Recorder()
+
+    def test_fires_in_deadline_order(self):
+        now = time()
+        self.scheduler.schedule('late', now + 0.3, self.fired)
+        self.scheduler.schedule('early', now + 0.1, self.fired)
+        self.scheduler.schedule_in('middle', 0.2, self.fired)
+        self.assertEqual(self.fired.wait_for(3), [['early'], ['middle'], ['late']])
+        self.assertEqual(len(self.scheduler), 0)
+
+    def test_timers_due_together_fire_in_one_batch(self):
+        deadline = time() + 0.1
+        self.scheduler.schedule_many([('a', deadline), ('b', deadline), ('c', deadline + 0.1)], self.fired)
+        self.scheduler.schedule('d', deadline, self.fired)
+        other = Recorder()
+        self.scheduler.schedule('e', deadline, other)
+        self.assertEqual(self.fired.wait_for(2), [['a', 'b', 'd'], ['c']])
+        self.assertEqual(other.wait_for(1), [['e']])
+
+    def test_cancel(self):
+        now = time()
+        self.scheduler.schedule('kept', now + 0.2, self.fired)
+        self.scheduler.schedule('cancelled', now + 0.1, self.fired)
+        self.assertTrue(self.scheduler.cancel('cancelled'))
+        self.assertFalse(self.scheduler.cancel('cancelled'))
+        self.assertFalse(self.scheduler.cancel('unknown'))
+        self.assertEqual(self.fired.wait_for(2, 0.5), [['kept']])
+
+    def test_rescheduling_replaces_the_timer(self):
+        now = time()
+        self.scheduler.schedule('key', now + 60, self.fired)
+        self.scheduler.schedule('key', now + 0.1, self.fired)
+        self.assertEqual(self.scheduler.deadline('key'), now + 0.1)
+        self.assertEqual(len(self.scheduler), 1)
+        self.assertEqual(self.fired.wait_for(2, 0.5), [['key']])
+        self.assertIsNone(self.scheduler.deadline('key'))
+
+    def test_cancelled_timers_are_compacted(self):
+        now = time()
+        self.scheduler.schedule_many([(i, now + 3600 + i) for i in range(1000)], self.fired)
+        for i in range(900):
+            self.scheduler.cancel(i)
+        self.assertEqual(len(self.scheduler), 100)
+        self.assertLessEqual(len(self.scheduler._heap), 2 * len(self.scheduler) + 1)
+        self.assertEqual(self.scheduler.deadline(950), now + 3600 + 950)
+        self.scheduler.schedule(999, now + 0.1, self.fired)
+        self.assertEqual(self.fired.wait_for(1), [[999]])
+
+    def test_failing_callback_does_not_stop_the_scheduler(self):
+
+        def fail(keys: list):
+            raise RuntimeError("Callback failure")
+
+        now = time()
+        self.scheduler.schedule('failing', now + 0.05, fail)
+        self.scheduler.schedule('next', now + 0.1, self.fired)
+        self.assertEqual(self.fired.wait_for(1), [['next']])
+
+
+if __name__ == '__main__':
+    unittest.main()